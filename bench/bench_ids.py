@@ -0,0 +1,97 @@
+"""
+比较旧的 50 字符主键（LegacyIdGenerator）与 13 字符按时间递增主键（SnowflakeIdGenerator）：
+    1. 生成 ID 的速度（不需要数据库）；
+    2. 插入吞吐量，以及插入后表的数据和索引大小（需要可以建表的 MySQL 账号）。
+
+用法（在项目根目录下运行）：
+    python -m bench.bench_ids --rows 200000 --user root --password xxx --db awesome_bench
+不指定 --user 时只运行第 1 项。
+每种方案建一张与 comments 结构相同的表（主键 + blog_id/user_id 二级索引），按批次并发插入。
+"""
+
+import argparse
+import asyncio
+import time
+
+from www import ids, orm
+
+_DDL = '''create table `%s` (
+   `id` %s not null,
+   `blog_id` %s not null,
+   `user_id` %s not null,
+   `content` varchar(200) not null,
+   `created_at` real not null,
+   key `idx_blog_id` (`blog_id`),
+   key `idx_user_id` (`user_id`),
+   primary key (`id`)
+) engine=innodb default charset=utf8'''
+
+_SCHEMES = [
+    ('bench_ids_legacy', 'varchar(50)', ids.LegacyIdGenerator()),
+    ('bench_ids_snowflake', 'char(%d)' % ids.ID_LENGTH, ids.SnowflakeIdGenerator(0)),
+]
+
+
+def bench_generate(n):
+    for table, ddl, gen in _SCHEMES:
+        start = time.perf_counter()
+        for _ in range(n):
+            gen()
+        elapsed = time.perf_counter() - start
+        print('%-22s generate: %10.0f ids/s  (%.2f us/id, %d chars)' % (
+            table, n / elapsed, elapsed / n * 1e6, len(gen())))
+
+
+async def bench_insert(table, ddl, gen, rows, batch, concurrency):
+    await orm.execute('drop table if exists `%s`' % table, [])
+    await orm.execute(_DDL % (table, ddl, ddl, ddl), [])
+    # 每条评论引用的 blog 和 user 从少量 ID 中选取，模拟真实的二级索引分布
+    blog_ids = [gen() for _ in range(100)]
+    user_ids = [gen() for _ in range(1000)]
+    sql = 'insert into `%s` (`id`, `blog_id`, `user_id`, `content`, `created_at`) values %s' % (
+        table, ', '.join(['(?, ?, ?, ?, ?)'] * batch))
+
+    async def worker(n):
+        for i in range(n):
+            args = []
+            for j in range(batch):
+                k = i * batch + j
+                args.extend([gen(), blog_ids[k % len(blog_ids)], user_ids[k % len(user_ids)], 'x' * 100, time.time()])
+            await orm.execute(sql, args)
+
+    batches = rows // batch
+    start = time.perf_counter()
+    await asyncio.gather(*[worker(batches // concurrency) for _ in range(concurrency)])
+    elapsed = time.perf_counter() - start
+    inserted = batches // concurrency * concurrency * batch
+
+    await orm.select('analyze table `%s`' % table, [])
+    rs = await orm.select('select data_length, index_length from information_schema.tables '
+                          'where table_schema=database() and table_name=?', [table])
+    print('%-22s insert: %10.0f rows/s  data: %8.1f MB  secondary indexes: %8.1f MB' % (
+        table, inserted / elapsed, rs[0]['data_length'] / 2 ** 20, rs[0]['index_length'] / 2 ** 20))
+    await orm.execute('drop table `%s`' % table, [])
+
+
+async def main(args):
+    bench_generate(args.generate)
+    if not args.user:
+        return
+    await orm.create_pool(host=args.host, port=args.port, user=args.user, password=args.password, db=args.db,
+                          maxsize=args.concurrency, minsize=args.concurrency)
+    for table, ddl, gen in _SCHEMES:
+        await bench_insert(table, ddl, gen, args.rows, args.batch, args.concurrency)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--generate', type=int, default=1000000, help='number of ids to generate')
+    parser.add_argument('--rows', type=int, default=200000, help='number of rows to insert')
+    parser.add_argument('--batch', type=int, default=500, help='rows per insert statement')
+    parser.add_argument('--concurrency', type=int, default=4, help='concurrent insert connections')
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=3306)
+    parser.add_argument('--user')
+    parser.add_argument('--password')
+    parser.add_argument('--db', default='awesome_bench')
+    asyncio.run(main(parser.parse_args()))
@@ -0,0 +1,86 @@
+"""
+比较 Model 的通用实现与 ModelMetaclass 生成的专用函数的单行 CPU 开销（不需要数据库）：
+    - insert 参数：map(getValueOrDefault, ...) 与 __insert_args__()
+    - update 参数：map(getValue, ...) 与 __update_args__()
+    - 行到实例：cls(**row) 与 __from_row__(row, ...)
+
+用法（在项目根目录下运行）：
+    python -m bench.bench_model --rows 200000
+"""
+
+import argparse
+import time
+
+from www.models import Blog, User
+
+
+def _bench(fn, rows):
+    """返回每行的耗时（纳秒）"""
+    fn(1000)  # 预热
+    start = time.perf_counter()
+    fn(rows)
+    return (time.perf_counter() - start) / rows * 1e9
+
+
+def _insert_generic(model, n):
+    fields, pk = model.__fields__, model.__primaryKey__
+    for _ in range(n):
+        obj = model(name='name', summary='summary')  # 其他列取默认值或 None
+        args = list(map(obj.getValueOrDefault, fields))
+        args.append(obj.getValueOrDefault(pk))
+
+
+def _insert_generated(model, n):
+    for _ in range(n):
+        obj = model(name='name', summary='summary')
+        obj.__insert_args__()
+
+
+def _update_generic(obj, n):
+    fields, pk = obj.__fields__, obj.__primaryKey__
+    for _ in range(n):
+        args = list(map(obj.getValue, fields))
+        args.append(obj.getValue(pk))
+
+
+def _update_generated(obj, n):
+    for _ in range(n):
+        obj.__update_args__()
+
+
+def _rows_generic(model, row, n):
+    for _ in range(n):
+        model(**row)
+
+
+def _rows_generated(model, row, n):
+    from_row = model.__from_row__
+    for _ in range(n):
+        from_row(row, None)
+
+
+def main(rows):
+    blog_row = dict(id='0rza4kqcc3m00', user_id='0rza4kqcc3m01', user_name='user', user_image='image', name='name',
+                    summary='summary', created_at=time.time())
+    user_row = dict(id='0rza4kqcc3m01', email='a@example.com', passwd='x' * 40, admin=False, name='user',
+                    image='image', created_at=time.time())
+    blog = Blog.__from_row__(blog_row, None)
+    cases = [
+        ('Blog insert args', lambda n: _insert_generic(Blog, n), lambda n: _insert_generated(Blog, n)),
+        ('Blog update args', lambda n: _update_generic(blog, n), lambda n: _update_generated(blog, n)),
+        ('Blog row mapping', lambda n: _rows_generic(Blog, blog_row, n),
+         lambda n: _rows_generated(Blog, blog_row, n)),
+        ('User row mapping', lambda n: _rows_generic(User, user_row, n),
+         lambda n: _rows_generated(User, user_row, n)),
+    ]
+    print('%-20s %14s %14s %8s' % ('', 'generic ns/row', 'generated', 'speedup'))
+    for name, generic, generated in cases:
+        before = _bench(generic, rows)
+        after = _bench(generated, rows)
+        print('%-20s %14.0f %14.0f %7.2fx' % (name, before, after, before / after))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--rows', type=int, default=200000, help='rows per case')
+    main(parser.parse_args().rows)
@@ -11,7 +11,7 @@ grant select, insert, update, delete on awesome.* to 'www-data'@'localhost' with
 --grant select, insert, update, delete on awesome.* to 'www-data'@'localhost' identified by 'www-data';
 
 create table users (
-   `id` varchar(50) not null,
+   `id` char(13) not null,
    `email` varchar(50) not null,
    `passwd` varchar(50) not null,
    `admin` bool not null,
@@ -24,26 +24,30 @@ create table users (
 ) engine=innodb default charset=utf8;
 
 create table blogs (
-   `id` varchar(50) not null,
-   `user_id` varchar(50) not null,
+   `id` char(13) not null,
+   `user_id` char(13) not null,
    `user_name` varchar(50) not null,
    `user_image` varchar(500) not null,
    `name` varchar(50) not null,
    `summary` varchar(200) not null,
    `content` mediumtext not null,
+   `views` bigint not null default 0,
    `created_at` real not null,
+   key `idx_user_id` (`user_id`),
    key `idx_created_at` (`created_at`),
    primary key (`id`)
 ) engine=innodb default charset=utf8;
 
 create table comments (
-      `id` varchar(50) not null,
-      `blog_id` varchar(50) not null,
-      `user_id` varchar(50) not null,
+      `id` char(13) not null,
+      `blog_id` char(13) not null,
+      `user_id` char(13) not null,
       `user_name` varchar(50) not null,
       `user_image` varchar(500) not null,
       `content` mediumtext not null,
       `created_at` real not null,
+      key `idx_blog_id` (`blog_id`),
+      key `idx_user_id` (`user_id`),
       key `idx_created_at` (`created_at`),
       primary key (`id`)
 ) engine=innodb default charset=utf8;
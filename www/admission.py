@@ -0,0 +1,122 @@
+"""
+准入控制（admission control）与过载保护（load shedding）
+数据库变慢时，请求会在连接池上无限排队，所有请求的延迟都会随队列变长而增加。
+本模块提供一个 middleware：
+    1. 按路由限制同时执行的请求数，超出的请求进入有界的等待队列；
+    2. 队列已满、排队超时或连接池等待时间超过阈值时，直接返回 503 并带上 Retry-After，让客户端稍后重试。
+"""
+
+import asyncio
+import logging
+
+from aiohttp import web
+
+from www import orm
+
+
+class RouteLimiter:
+    """
+    单个路由的并发限制
+    :param concurrency: 最多同时执行的请求数
+    :param queue: 最多排队等待的请求数
+    :param timeout: 排队等待的最长时间（秒），None 表示不限
+    """
+
+    def __init__(self, concurrency, queue, timeout=None):
+        self.concurrency = concurrency
+        self.queue = queue
+        self.timeout = timeout
+        self.waiting = 0
+        self._sem = asyncio.Semaphore(concurrency)
+
+    async def acquire(self):
+        """获取执行名额，失败（队列已满或排队超时）时返回 False"""
+        if not self._sem.locked():
+            await self._sem.acquire()
+            return True
+        if self.waiting >= self.queue:
+            return False
+        self.waiting += 1
+        try:
+            await asyncio.wait_for(self._sem.acquire(), self.timeout)
+            return True
+        except asyncio.TimeoutError:
+            return False
+        finally:
+            self.waiting -= 1
+
+    def release(self):
+        self._sem.release()
+
+
+# 未匹配到路由（404、405）的请求共用的限流 key
+_UNMATCHED = '<unmatched>'
+
+
+def _route_key(request):
+    """
+    用路由的规范路径作为限流的 key，如 /blog/{id}
+    未匹配到路由的请求共用一个 key：按请求路径区分时，随机路径会让 limiters 无限增长
+    """
+    resource = request.match_info.route.resource
+    if resource is None:
+        return _UNMATCHED
+    return resource.canonical
+
+
+def admission_factory(**kw):
+    """
+    通过闭包的方式将限流配置注入 middleware，并返回该 middleware
+    :param concurrency: 默认每个路由的并发上限
+    :param queue: 默认每个路由的等待队列长度
+    :param queue_timeout: 默认的排队超时时间（秒）
+    :param max_pool_wait: 连接池等待时间的阈值（秒），超过时直接拒绝新请求
+    :param retry_after: 503 响应中 Retry-After 头的值（秒）
+    :param routes: 单独配置的路由，如 {'/api/users': {'concurrency': 4, 'queue': 16}}
+    :param exclude: 不做限流的路径前缀，如静态文件
+    """
+    concurrency = kw.get('concurrency', 64)
+    queue = kw.get('queue', 128)
+    queue_timeout = kw.get('queue_timeout', None)
+    max_pool_wait = kw.get('max_pool_wait', None)
+    retry_after = str(kw.get('retry_after', 1))
+    routes = kw.get('routes', None) or dict()
+    exclude = tuple(kw.get('exclude', ('/static/',)))
+
+    limiters = dict()
+
+    def get_limiter(key):
+        limiter = limiters.get(key)
+        if limiter is None:
+            conf = routes.get(key, None) or dict()
+            limiter = RouteLimiter(conf.get('concurrency', concurrency), conf.get('queue', queue),
+                                   conf.get('queue_timeout', queue_timeout))
+            limiters[key] = limiter
+        return limiter
+
+    def reject(reason):
+        logging.warning('request rejected: %s' % reason)
+        return web.HTTPServiceUnavailable(headers={'Retry-After': retry_after})
+
+    @web.middleware
+    async def admission(request, handler):
+        """
+        在调用handler前检查是否还有执行名额，没有就快速返回 503
+        """
+        if request.path.startswith(exclude):
+            return await handler(request)
+        key = _route_key(request)
+        if max_pool_wait is not None:
+            waited = orm.pool_wait()
+            if waited > max_pool_wait:
+                return reject('pool wait %.3fs exceeds %.3fs (%s)' % (waited, max_pool_wait, key))
+        limiter = get_limiter(key)
+        if not await limiter.acquire():
+            return reject('route %s is saturated (concurrency=%s, queue=%s)' % (
+                key, limiter.concurrency, limiter.queue))
+        try:
+            return await handler(request)
+        finally:
+            limiter.release()
+
+    return admission
@@ -14,7 +14,9 @@ from pathlib import Path
 from aiohttp import web
 from jinja2 import Environment, FileSystemLoader
 
-from www import orm
+from www import counters, ids, jobs, orm, profiling, tracing
+from www.admission import admission_factory
+from www.cache import QueryCache, create_backend, set_backend
 from www.coroweb import add_routes, add_static
 from www.config import configs
 from handlers import _cookie2user, COOKIE_NAME
@@ -98,6 +100,29 @@ async def logger(request, handler):
     logging.info('Request: %s %s' % (request.method, request.path))
     return await handler(request)
 
+def deadline_factory(timeout):
+    """
+    通过闭包的方式将超时时间注入 middleware，并返回该闭包
+    :param timeout: 每个请求的处理时限（秒）
+    """
+
+    @web.middleware
+    async def deadline(request, handler):
+        """
+        为请求设置截止时间，ORM 的 select 和 execute 会遵守该时间，超时的语句在服务端被取消
+        """
+        token = orm.set_deadline(timeout)
+        try:
+            return await handler(request)
+        except orm.DeadlineExceeded as e:
+            logging.warning('request deadline exceeded: %s %s (%s)' % (request.method, request.path, e))
+            return web.HTTPGatewayTimeout()
+        finally:
+            orm.reset_deadline(token)
+
+    return deadline
+
+
 @web.middleware
 async def auth(request, handler):
     """在调用handler前解析cookie，以检查登陆状态"""
@@ -105,7 +130,8 @@ async def auth(request, handler):
     request.__user__ = None
     cookie_str = request.cookies.get(COOKIE_NAME)
     if cookie_str:
-        user = await _cookie2user(cookie_str)
+        with tracing.span('auth'):
+            user = await _cookie2user(cookie_str)
         if user:
             logging.info('set current user: %s' % user.email)
             request.__user__ = user
@@ -128,10 +154,42 @@ async def auth(request, handler):
 #     return await handler(request)
 
 
-def response_factory(env):
+async def render_stream(request, template, context, buffer_size=16 * 1024, threshold=0):
+    """
+    用 jinja2 的 generate() 边渲染边发送，不必等整个页面渲染完成，也不用在内存中保存整个页面
+    - 渲染结果先缓存，累计超过 threshold 字节后才开始以 chunked 方式发送；
+      整个页面不超过 threshold 时，仍然作为普通的 Response 返回（带 Content-Length）
+    - 每累计 buffer_size 字节发送一次，避免每个模版片段都触发一次写操作
+    """
+    buf, size, resp = [], 0, None
+    for chunk in template.generate(**context):
+        data = chunk.encode('utf-8')
+        buf.append(data)
+        size += len(data)
+        if resp is None and size >= threshold:
+            resp = web.StreamResponse()
+            resp.content_type = 'text/html;charset=utf-8'
+            resp.enable_chunked_encoding()
+            await resp.prepare(request)
+        if resp is not None and size >= buffer_size:
+            await resp.write(b''.join(buf))
+            buf, size = [], 0
+    if resp is None:
+        resp = web.Response(body=b''.join(buf))
+        resp.content_type = 'text/html;charset=utf-8'
+        return resp
+    if buf:
+        await resp.write(b''.join(buf))
+    await resp.write_eof()
+    return resp
+
+
+def response_factory(env, stream_buffer_size=16 * 1024, stream_threshold=None):
     """
     通过闭包的方式将 env 注入 response 处理方法，并返回该闭包
     :param env: jinja2 的核心组件 env
+    :param stream_buffer_size: 流式渲染时每次发送的字节数
+    :param stream_threshold: 页面超过该字节数时改为流式发送，None 表示只有 handler 返回 '__stream__': True 时才流式渲染
     """
 
     @web.middleware
@@ -165,7 +223,15 @@ def response_factory(env):
             else:
                 # 访问 jinja2 的核心组件 env，用来获取html模版
                 r['__user__'] = request.__user__  # 统一注入用户信息
-                resp = web.Response(body=env.get_template(template).render(**r).encode('utf-8'))
+                if r.get('__stream__', False) or stream_threshold is not None:
+                    # handler 可以返回 '__stream__': True 使该页面立即开始流式发送
+                    threshold = 0 if r.get('__stream__', False) else stream_threshold
+                    with tracing.span('render'):
+                        return await render_stream(request, env.get_template(template), r, stream_buffer_size,
+                                                   threshold)
+                with tracing.span('render'):
+                    body = env.get_template(template).render(**r).encode('utf-8')
+                resp = web.Response(body=body)
                 resp.content_type = 'text/html;charset=utf-8'
                 return resp
         if isinstance(r, int) and 100 <= r < 600:
@@ -186,15 +252,39 @@ def response_factory(env):
 # 应用初始化 #
 ############
 async def init():
+    # 每个进程的 worker id 必须互不相同：未配置时在本机的槽位文件中独占一个
+    ids.set_generator(ids.SnowflakeIdGenerator(configs.ids.worker_id, configs.ids.lock_dir,
+                                               configs.ids.worker_range))
     # 创建全局数据库连接池
-    await orm.create_pool(host=configs.db.host, port=configs.db.port, user=configs.db.user,
-                          password=configs.db.password, db=configs.db.db)
+    await orm.create_pool(**configs.db)
+    # 开启查询结果缓存，findAll、findNumber 通过 cache 参数选择使用
+    orm.set_query_cache(QueryCache(**configs.cache))
+    # 缓存后端，用于会话用户和 Model.find 的缓存；shm 后端在同一台机器的所有 worker 之间共享
+    backend = configs.cache_backend.backend
+    set_backend(create_backend(backend, **configs.cache_backend.get(backend, dict())))
     # 初始化 jinja2
     env = init_jinja2(filters=dict(datetime=datetime_filter))
     # 创建 aiohttp 服务器
-    app = web.Application(middlewares=[logger, auth, response_factory(env)])
+    # tracing 放在最前面，统计整个请求的耗时
+    # admission 放在 auth 之前，过载时不再为被拒绝的请求查询用户信息
+    # deadline 放在 auth 之前，auth 中查询用户的语句也受截止时间约束
+    app = web.Application(middlewares=[tracing.tracing_factory(configs.tracing.sample_rate),
+                                       logger, admission_factory(**configs.admission),
+                                       deadline_factory(configs.deadline.timeout), auth, profiling.request_profiler,
+                                       response_factory(env, configs.stream.buffer_size, configs.stream.threshold)])
+    # 在响应头发送前加上 Server-Timing 和 X-Profile-Id 头，流式响应也能带上
+    app.on_response_prepare.append(tracing.on_response_prepare)
+    app.on_response_prepare.append(profiling.on_response_prepare)
+    # 后台任务队列，应用关闭时执行完已提交的任务
+    jobs.init(**configs.jobs)
+    app.on_shutdown.append(jobs.shutdown)
+    # 浏览次数定期批量写回，应用关闭时写回剩余的增量
+    app.on_startup.append(counters.startup)
+    app.on_shutdown.append(counters.shutdown)
     # 批量注册handlers模块下的处理方法
     add_routes(app, 'handlers')
+    # /manage/ 下的性能分析接口，只有管理员可以访问
+    add_routes(app, 'www.profiling')
     # 注册静态资源默认的存储位置
     add_static(app)
     return app
@@ -0,0 +1,322 @@
+"""
+1. 查询结果缓存 QueryCache（进程内）
+以最终的 SQL 语句和参数为 key 缓存查询结果，每条缓存带上所属表名作为标签（tag），
+该表有写操作（Model 的 save、update、remove）时，使该标签下的所有缓存失效。
+    - 每条缓存可以有自己的过期时间（TTL）；
+    - 缓存总大小有上限，超出时按 LRU 淘汰最久未使用的缓存。
+注意：失效只在当前进程内生效，直接调用 orm.execute 的写操作需要手动调用 orm.invalidate，过期时间是数据陈旧程度的上限。
+2. 可插拔的缓存后端 CacheBackend，包括进程内的 LRU 和多个 worker 共享的内存实现，见下文
+"""
+
+import collections
+import contextlib
+import fcntl
+import importlib
+import logging
+import mmap
+import os
+import pickle
+import struct
+import sys
+import time
+import zlib
+
+
+def _sizeof(value):
+    """粗略估算查询结果（由 dict 组成的 list）占用的内存"""
+    size = sys.getsizeof(value)
+    if isinstance(value, (list, tuple)):
+        for row in value:
+            size += sys.getsizeof(row)
+            if isinstance(row, dict):
+                size += sum(sys.getsizeof(v) for v in row.values())
+    return size
+
+
+class QueryCache:
+    """
+    带标签失效、TTL 和内存上限的 LRU 缓存
+    :param max_bytes: 缓存总大小的上限（字节）
+    :param default_ttl: 默认过期时间（秒）
+    """
+
+    def __init__(self, max_bytes=64 * 1024 * 1024, default_ttl=60):
+        self.max_bytes = max_bytes
+        self.default_ttl = default_ttl
+        self.size = 0
+        self._entries = collections.OrderedDict()  # key => (value, 过期时间, 大小, 标签)
+        self._tags = collections.defaultdict(set)  # 标签 => key 集合
+        self._versions = collections.defaultdict(int)  # 标签 => 版本号，每次失效加一
+
+    def version(self, tag):
+        """标签的当前版本，查询前记录，写入缓存时用于判断查询期间是否发生过失效"""
+        return self._versions[tag]
+
+    def get(self, key):
+        """返回缓存的值，不存在或已过期时返回 None"""
+        entry = self._entries.get(key)
+        if entry is None:
+            return None
+        if entry[1] < time.monotonic():
+            self._remove(key)
+            return None
+        self._entries.move_to_end(key)  # 最近使用的放到末尾
+        return entry[0]
+
+    def set(self, key, value, tag, version, ttl=None):
+        """
+        写入缓存。如果查询期间该标签已经失效（版本号变化），查询结果可能是旧数据，不写入
+        """
+        if self._versions[tag] != version:
+            return
+        size = _sizeof(value)
+        if size > self.max_bytes:
+            return
+        if key in self._entries:
+            self._remove(key)
+        expires = time.monotonic() + (self.default_ttl if ttl is None else ttl)
+        self._entries[key] = (value, expires, size, tag)
+        self._tags[tag].add(key)
+        self.size += size
+        while self.size > self.max_bytes:
+            self._remove(next(iter(self._entries)))  # 淘汰最久未使用的
+
+    def invalidate(self, tag):
+        """使标签下的所有缓存失效"""
+        self._versions[tag] += 1
+        keys = self._tags.pop(tag, ())
+        for key in keys:
+            self._remove(key)
+        if keys:
+            logging.debug('invalidate %d cached queries of %s' % (len(keys), tag))
+
+    def clear(self):
+        for tag in list(self._tags):
+            self.invalidate(tag)
+
+    def _remove(self, key):
+        value, expires, size, tag = self._entries.pop(key)
+        self.size -= size
+        keys = self._tags.get(tag)
+        if keys is not None:
+            keys.discard(key)
+
+
+###############
+#  缓存后端   #
+###############
+"""
+跨进程共享的缓存层
+同一台机器上运行多个 worker 进程时，进程内的缓存（会话用户、Model.find 的结果等）在每个进程中各有一份，
+部署后每个进程都要重新预热。CacheBackend 定义了统一的接口，可以选择：
+    - LocalCache: 进程内的 LRU；
+    - SharedMemoryCache: 基于 mmap 文件（如 /dev/shm 下）的组相联哈希表，同一台机器上的所有 worker 共享；
+    - 其他实现，如访问本机 memcached/redis 的后端：继承 CacheBackend，并在配置中以 'module.ClassName' 指定。
+接口的方法都是协程，以便支持基于网络的后端。值需要可以 pickle。
+"""
+
+
+class CacheBackend:
+    """缓存后端接口"""
+
+    async def get(self, key):
+        """返回缓存的值，不存在或已过期时返回 None"""
+        raise NotImplementedError
+
+    async def set(self, key, value, ttl=None):
+        """写入缓存，ttl 为过期时间（秒），None 表示使用默认值"""
+        raise NotImplementedError
+
+    async def delete(self, key):
+        raise NotImplementedError
+
+    async def clear(self):
+        raise NotImplementedError
+
+
+class LocalCache(CacheBackend):
+    """
+    进程内的 LRU 缓存
+    :param max_items: 最多缓存的条数，超出时淘汰最久未使用的
+    :param default_ttl: 默认过期时间（秒）
+    """
+
+    def __init__(self, max_items=10000, default_ttl=60):
+        self.max_items = max_items
+        self.default_ttl = default_ttl
+        self._entries = collections.OrderedDict()  # key => (value, 过期时间)
+
+    async def get(self, key):
+        entry = self._entries.get(key)
+        if entry is None:
+            return None
+        if entry[1] < time.time():
+            del self._entries[key]
+            return None
+        self._entries.move_to_end(key)
+        return entry[0]
+
+    async def set(self, key, value, ttl=None):
+        self._entries[key] = (value, time.time() + (self.default_ttl if ttl is None else ttl))
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.max_items:
+            self._entries.popitem(last=False)
+
+    async def delete(self, key):
+        self._entries.pop(key, None)
+
+    async def clear(self):
+        self._entries.clear()
+
+
+class SharedMemoryCache(CacheBackend):
+    """
+    基于 mmap 文件的组相联（set-associative）哈希表，多个进程映射同一个文件即可共享缓存
+    - 文件分为 sets 组，每组 ways 个定长的槽（slot），key 按 crc32 映射到一组；
+    - 写入时优先使用同 key、空闲或已过期的槽，都没有时淘汰组内最久未使用的槽（组内 LRU）；
+    - 每次操作用 fcntl 记录锁锁住所在的组，不同组的操作可以在多个进程中并行；
+    - 每个槽保存 key 和 pickle 后的值，超过 slot_size 的值不缓存。
+    其他进程可能已经映射了文件，文件创建后不再改变大小（截断已映射的文件会让其他进程 SIGBUS 或读到损坏的槽），
+    因此实际的文件名带上结构参数：滚动部署中修改了 sets/ways/slot_size 时，新旧 worker 使用不同的文件。
+    :param path: 共享的文件路径前缀，放在 /dev/shm 下即为内存文件
+    """
+
+    _MAGIC = b'AWCACHE1'
+    _HEADER = struct.Struct('<8sIII')  # magic, sets, ways, slot_size
+    _HEADER_SIZE = 64
+    _SLOT = struct.Struct('<B3xIIdd')  # 是否使用, key 长度, 值长度, 过期时间, 最近使用时间
+
+    def __init__(self, path='/dev/shm/awesome-cache', sets=4096, ways=8, slot_size=2048, default_ttl=60):
+        self.path = '%s.%d-%d-%d' % (path, sets, ways, slot_size)
+        self.sets = sets
+        self.ways = ways
+        self.slot_size = slot_size
+        self.default_ttl = default_ttl
+        self._set_size = ways * slot_size
+        size = self._HEADER_SIZE + sets * self._set_size
+        self._fd = os.open(self.path, os.O_RDWR | os.O_CREAT, 0o600)
+        # 第一个打开文件的进程初始化文件：文件是新建的（大小为 0）时扩展到 size（内容全为 0）并写入文件头
+        fcntl.flock(self._fd, fcntl.LOCK_EX)
+        try:
+            header = self._HEADER.pack(self._MAGIC, sets, ways, slot_size)
+            current = os.fstat(self._fd).st_size
+            if current == 0:
+                logging.info('initialize shared cache file: %s' % self.path)
+                os.ftruncate(self._fd, size)
+                os.pwrite(self._fd, header, 0)
+                current = size
+            valid = current == size and os.pread(self._fd, self._HEADER.size, 0) == header
+        finally:
+            fcntl.flock(self._fd, fcntl.LOCK_UN)
+        if not valid:
+            os.close(self._fd)
+            raise ValueError('shared cache file %s does not match the configuration, remove it or use another path'
+                             % self.path)
+        self._mm = mmap.mmap(self._fd, size)
+
+    @contextlib.contextmanager
+    def _locked(self, base):
+        fcntl.lockf(self._fd, fcntl.LOCK_EX, self._set_size, base)
+        try:
+            yield
+        finally:
+            fcntl.lockf(self._fd, fcntl.LOCK_UN, self._set_size, base)
+
+    def _set_base(self, kb):
+        return self._HEADER_SIZE + zlib.crc32(kb) % self.sets * self._set_size
+
+    def _find(self, base, kb):
+        """返回组内 key 为 kb 的槽的偏移量，没有时返回 None"""
+        mm, slot = self._mm, self._SLOT
+        for off in range(base, base + self._set_size, self.slot_size):
+            used, klen, vlen, expires, last_used = slot.unpack_from(mm, off)
+            if used and klen == len(kb) and mm[off + slot.size:off + slot.size + klen] == kb:
+                return off
+        return None
+
+    async def get(self, key):
+        kb = key.encode('utf-8')
+        base = self._set_base(kb)
+        mm, slot = self._mm, self._SLOT
+        with self._locked(base):
+            off = self._find(base, kb)
+            if off is None:
+                return None
+            used, klen, vlen, expires, last_used = slot.unpack_from(mm, off)
+            now = time.time()
+            if expires < now:
+                slot.pack_into(mm, off, 0, 0, 0, 0, 0)
+                return None
+            slot.pack_into(mm, off, 1, klen, vlen, expires, now)
+            start = off + slot.size + klen
+            data = mm[start:start + vlen]
+        return pickle.loads(data)
+
+    async def set(self, key, value, ttl=None):
+        kb = key.encode('utf-8')
+        data = pickle.dumps(value, pickle.HIGHEST_PROTOCOL)
+        slot = self._SLOT
+        if slot.size + len(kb) + len(data) > self.slot_size:
+            return
+        base = self._set_base(kb)
+        mm = self._mm
+        now = time.time()
+        with self._locked(base):
+            off = self._find(base, kb)
+            if off is None:
+                # 没有同 key 的槽：使用空闲或已过期的槽，否则淘汰最久未使用的
+                victim, oldest = None, None
+                for o in range(base, base + self._set_size, self.slot_size):
+                    used, klen, vlen, expires, last_used = slot.unpack_from(mm, o)
+                    if not used or expires < now:
+                        victim = o
+                        break
+                    if oldest is None or last_used < oldest:
+                        victim, oldest = o, last_used
+                off = victim
+            start = off + slot.size
+            mm[start:start + len(kb) + len(data)] = kb + data
+            expires = now + (self.default_ttl if ttl is None else ttl)
+            slot.pack_into(mm, off, 1, len(kb), len(data), expires, now)
+
+    async def delete(self, key):
+        kb = key.encode('utf-8')
+        base = self._set_base(kb)
+        with self._locked(base):
+            off = self._find(base, kb)
+            if off is not None:
+                self._SLOT.pack_into(self._mm, off, 0, 0, 0, 0, 0)
+
+    async def clear(self):
+        for base in range(self._HEADER_SIZE, self._HEADER_SIZE + self.sets * self._set_size, self._set_size):
+            with self._locked(base):
+                for off in range(base, base + self._set_size, self.slot_size):
+                    self._SLOT.pack_into(self._mm, off, 0, 0, 0, 0, 0)
+
+
+def create_backend(backend='local', **kw):
+    """
+    按配置创建缓存后端
+    :param backend: 'local'、'shm'，或自定义后端的 'module.ClassName'，其余参数传给后端的构造函数
+    """
+    if backend == 'local':
+        return LocalCache(**kw)
+    if backend == 'shm':
+        return SharedMemoryCache(**kw)
+    module_name, _, class_name = backend.rpartition('.')
+    if not module_name:
+        raise ValueError('Invalid cache backend: %s' % backend)
+    return getattr(importlib.import_module(module_name), class_name)(**kw)
+
+
+# 全局的缓存后端，默认是进程内的 LRU
+_backend = LocalCache()
+
+
+def set_backend(backend):
+    global _backend
+    _backend = backend
+
+
+def get_backend():
+    return _backend
@@ -9,9 +9,82 @@ configs = {
         'port': 3306,
         'user': 'www-data',
         'password': 'www-data',
-        'db': 'awesome'
+        'db': 'awesome',
+        'minsize': 5,  # 启动时预先建立的连接数，也是连接池保持的最少连接数
+        'maxsize': 10,  # 同时使用的最多连接数
+        'pool_recycle': 3600,  # 连接的最长空闲时间（秒），取出时空闲超过该时间的连接关闭重建
+        'max_lifetime': 3600,  # 连接的最长使用时间（秒），超过后关闭重建，无论是否繁忙
+        'ping_idle': 30,  # 空闲超过该时间（秒）的连接在使用前先 ping
+        'connect_timeout': 5,
+        'adaptive': None,  # 自适应连接数上限，如 {'max': 30, 'grow_wait': 0.05, 'shrink_wait': 0.005, 'interval': 5}
+        'request_connections': 3  # orm.gather 中一个请求最多同时占用的连接数
     },
     'session': {
         'secret': 'Awesome'
+    },
+    'cache_backend': {
+        # 'local' 为进程内的 LRU；'shm' 为同一台机器上所有 worker 共享的内存文件；
+        # 也可以是自定义后端的 'module.ClassName'（如访问本机 memcached/redis 的实现）
+        'backend': 'local',
+        'session_ttl': 60,  # 会话用户的缓存时间（秒）
+        # 以下为各后端构造函数的参数
+        'local': {
+            'max_items': 10000,
+            'default_ttl': 60
+        },
+        'shm': {
+            'path': '/dev/shm/awesome-cache',  # 文件名前缀，实际文件名带上 sets、ways、slot_size
+            'sets': 4096,  # 组数
+            'ways': 8,  # 每组的槽数
+            'slot_size': 2048,  # 每个槽的字节数，key 和 pickle 后的值超过该大小时不缓存
+            'default_ttl': 60
+        }
+    },
+    'ids': {
+        'worker_id': None,  # 主键生成器的 worker id（0 ~ 1023），None 表示启动时在本机的槽位文件中独占一个
+        'lock_dir': '/dev/shm/awesome-ids',  # 槽位文件所在目录
+        'worker_range': [0, 1024]  # 可用的槽位 [start, stop)，多台机器部署时为每台机器配置互不重叠的范围
+    },
+    'cache': {
+        'max_bytes': 64 * 1024 * 1024,  # 查询结果缓存的内存上限，超出时按 LRU 淘汰
+        'default_ttl': 60  # 查询结果默认的过期时间（秒）
+    },
+    'jobs': {
+        'concurrency': 4,  # 同时执行的后台任务数
+        'maxsize': 10000,  # 队列长度上限，满了丢弃新任务
+        'retries': 3,  # 失败后的重试次数
+        'drain_timeout': 30  # 应用关闭时等待已提交任务的最长时间（秒）
+    },
+    'stream': {
+        'buffer_size': 16 * 1024,  # 流式渲染时每次发送的字节数
+        'threshold': 256 * 1024  # 页面超过该字节数时改为流式发送，None 表示只对返回 '__stream__': True 的 handler 流式渲染
+    },
+    'counters': {
+        'flush_interval': 5  # 浏览次数写回数据库的间隔（秒）
+    },
+    'upload': {
+        'avatar_max_size': 2 * 1024 * 1024  # 头像文件的大小上限（字节）
+    },
+    'profiling': {
+        'dir': None,  # 单请求 pstats 文件的保存目录，None 表示系统临时目录下的 awesome-profiles
+        'max_seconds': 60  # 采样和内存分析的最长时间（秒）
+    },
+    'tracing': {
+        'sample_rate': 0.01  # 把请求内执行的 SQL 及耗时写入日志的请求比例
+    },
+    'deadline': {
+        'timeout': 10  # 每个请求的处理时限（秒），超时后正在执行的 SQL 会被取消
+    },
+    'admission': {
+        'concurrency': 64,  # 每个路由默认的并发上限
+        'queue': 128,  # 每个路由默认的等待队列长度
+        'queue_timeout': 5,  # 排队超时时间（秒）
+        'max_pool_wait': 1.0,  # 获取数据库连接的等待时间超过该值（秒）时直接返回 503
+        'retry_after': 1,  # 503 响应的 Retry-After（秒）
+        'routes': {
+            # 注册和登录需要计算 hash 并查询数据库，开销较大，单独限流
+            '/api/users': {'concurrency': 4, 'queue': 16},
+            '/api/authenticate': {'concurrency': 8, 'queue': 32},
+        }
     }
 }
@@ -7,13 +7,17 @@
 import asyncio
 import functools
 import logging
+import os
+import tempfile
 
 
 from aiohttp import web
+from aiohttp.multipart import BodyPartReader
 from aiohttp.web_request import Request
 from urllib import parse
 from pathlib import Path
 
+from www import tracing
 from www.apis import APIError
 
 from www.coroweb_helper import *
@@ -36,9 +40,11 @@ def get(path):
     return decorator
 
 
-def post(path):
+def post(path, max_upload=None):
     """
     Define decorator @post('/path')
+    :param max_upload: 指定后，multipart/form-data 请求体按流式读取，文件写入临时文件，
+        处理函数收到 UploadedFile 而不是文件内容；请求体超过 max_upload 字节时返回 413
     """
 
     def decorator(func):
@@ -48,11 +54,100 @@ def post(path):
 
         wrapper.__method__ = 'POST'
         wrapper.__route__ = path
+        wrapper.__max_upload__ = max_upload
         return wrapper
 
     return decorator
 
 
+class UploadedFile(object):
+    """
+    上传的文件，内容已写入临时文件
+    处理函数可以读取 file，或把 path 指向的文件移动到其他位置；请求处理完后临时文件会被删除
+    """
+
+    def __init__(self, name, filename, content_type, file):
+        self.name = name  # 表单字段名
+        self.filename = filename  # 客户端提供的文件名
+        self.content_type = content_type
+        self.file = file
+        self.path = file.name
+        self.size = 0
+
+    def cleanup(self):
+        self.file.close()
+        try:
+            os.unlink(self.path)
+        except FileNotFoundError:  # 已被处理函数移走
+            pass
+
+
+class UploadTooLarge(Exception):
+    """请求体超过大小限制，size 为抛出时已读取的字节数（没有 Content-Length 时实际大小未知）"""
+
+    def __init__(self, size):
+        super(UploadTooLarge, self).__init__(size)
+        self.size = size
+
+
+class InvalidMultipart(Exception):
+    """不支持的 multipart 请求体，如嵌套的 multipart"""
+    pass
+
+
+async def read_multipart(request, max_size, chunk_size=64 * 1024):
+    """
+    流式读取 multipart/form-data 请求体，不会把整个请求体读入内存
+    - 文件按 chunk_size 分块写入临时文件，写文件在线程池中执行，不阻塞事件循环
+    - 所有字段和文件的总大小超过 max_size 时抛出 UploadTooLarge
+    - 包含嵌套的 multipart 时抛出 InvalidMultipart
+    返回 (字段 dict, UploadedFile 列表)，文件也会以字段名放入 dict
+    """
+    loop = asyncio.get_event_loop()
+    kw, files, total = dict(), [], 0
+    reader = await request.multipart()
+    try:
+        while True:
+            part = await reader.next()
+            if part is None:
+                break
+            if not isinstance(part, BodyPartReader):
+                raise InvalidMultipart('nested multipart is not supported')
+            if part.filename is None:
+                # 普通字段，读取的长度同样受 max_size 限制
+                value = bytearray()
+                while True:
+                    chunk = await part.read_chunk(chunk_size)
+                    if not chunk:
+                        break
+                    total += len(chunk)
+                    if total > max_size:
+                        raise UploadTooLarge(total)
+                    value.extend(chunk)
+                kw[part.name] = value.decode(part.get_charset('utf-8'))
+                continue
+            f = await loop.run_in_executor(None, functools.partial(tempfile.NamedTemporaryFile, delete=False))
+            upload = UploadedFile(part.name, part.filename, part.headers.get('Content-Type'), f)
+            files.append(upload)
+            while True:
+                chunk = await part.read_chunk(chunk_size)
+                if not chunk:
+                    break
+                total += len(chunk)
+                upload.size += len(chunk)
+                if total > max_size:
+                    raise UploadTooLarge(total)
+                await loop.run_in_executor(None, f.write, chunk)
+            await loop.run_in_executor(None, f.flush)
+            f.seek(0)
+            kw[part.name] = upload
+    except BaseException:
+        for upload in files:
+            upload.cleanup()
+        raise
+    return kw, files
+
+
 class RequestHandler(object):
     """
     从URL函数中分析其需要接收的参数，从request中获取必要的参数，调用URL函数，然后把结果转换为web.Response对象
@@ -71,10 +166,13 @@ class RequestHandler(object):
         self._named_kw_args = get_named_kw_args(fn)
         # 获取 fn 的无默认值的 keyword-only 参数
         self._required_kw_args = get_required_kw_args(fn)
+        # 流式读取 multipart/form-data 时请求体的大小上限，None 表示使用 request.post()
+        self._max_upload = getattr(fn, '__max_upload__', None)
 
     async def __call__(self, request: Request):  # 使得实例可以视为函数一样调用
         # 步骤 1：获取参数
         kw = None
+        uploads = []
         # 先尝试从 request body 或 query string 中获取键值对参数（如 **args 或 keyword-only）
         if self._has_var_kw_arg or self._has_named_kw_args:
             if request.method == 'POST':
@@ -87,6 +185,20 @@ class RequestHandler(object):
                     if not isinstance(params, dict):
                         return web.HTTPBadRequest('JSON body must be object.')
                     kw = params
+                elif ct.startswith('multipart/form-data') and self._max_upload is not None:
+                    if request.content_length is not None and request.content_length > self._max_upload:
+                        return web.HTTPRequestEntityTooLarge(self._max_upload, request.content_length)
+                    try:
+                        kw, uploads = await read_multipart(request, self._max_upload)
+                    except UploadTooLarge as e:
+                        if request.content_length is not None:
+                            return web.HTTPRequestEntityTooLarge(self._max_upload, request.content_length)
+                        # 没有 Content-Length（分块传输）时只知道已读取的字节数，不报告实际大小
+                        return web.HTTPRequestEntityTooLarge(
+                            self._max_upload, e.size,
+                            text='Maximum request body size %d exceeded' % self._max_upload)
+                    except InvalidMultipart as e:
+                        return web.HTTPBadRequest(text=str(e))
                 elif ct.startswith('application/x-www-form-urlencoded') or ct.startswith('multipart/form-data'):
                     params = await request.post()
                     kw = dict(**params)
@@ -123,18 +235,24 @@ class RequestHandler(object):
         if self._has_request_arg:
             kw['request'] = request
 
-        # 检查是否包含必须的参数（不带默认值的）
-        for name in self._required_kw_args:
-            if name not in kw:
-                return web.HTTPBadRequest('Missing argument: %s' % name)
-
-        # 步骤 2：调用真正的处理函数，并返回结果
-        logging.info('call with args: %s' % str(kw))
         try:
-            r = await self._func(**kw)
-            return r
-        except APIError as e:
-            return dict(error=e.error, data=e.data, message=e.message)
+            # 检查是否包含必须的参数（不带默认值的）
+            for name in self._required_kw_args:
+                if name not in kw:
+                    return web.HTTPBadRequest('Missing argument: %s' % name)
+
+            # 步骤 2：调用真正的处理函数，并返回结果
+            logging.info('call with args: %s' % str(kw))
+            try:
+                with tracing.span('handler'):
+                    r = await self._func(**kw)
+                return r
+            except APIError as e:
+                return dict(error=e.error, data=e.data, message=e.message)
+        finally:
+            # 删除上传的临时文件
+            for upload in uploads:
+                upload.cleanup()
 
 
 def add_route(app, fn):
@@ -0,0 +1,112 @@
+"""
+写回（write-behind）计数器
+每次浏览都执行一条 update ... set views = views + 1 会给主库带来大量写入，热门文章的行锁也会成为瓶颈。
+ViewCounter 在内存中按主键累加增量，定期用一条语句批量写回：
+    update `blogs` set `views` = `views` + case `id` when ? then ? ... end where `id` in (...)
+    - 写回失败时把增量放回，下次重试；应用关闭时再写回一次；
+    - 显示的计数 = 数据库中的值 + 尚未写回的增量（views()）。
+计数列应当延迟加载（lazy=True），不进入缓存的查询结果：缓存中的计数不包含缓存之后写回的增量，
+写回后显示的计数会变小；而每次写回都使缓存失效，会让该表的查询缓存只能存活一个写回间隔。
+列表页从缓存取得实例后，用 load() 一条不经过缓存的查询批量取得计数。
+"""
+
+import asyncio
+import contextvars
+import logging
+
+from www.config import configs
+from www.models import Blog
+from www.orm import execute
+
+
+class ViewCounter:
+    """
+    :param model: 计数所在的 Model 类
+    :param column: 计数的列名
+    :param interval: 写回的间隔（秒）
+    :param batch_size: 每条语句最多更新的行数
+    """
+
+    def __init__(self, model, column, interval=5.0, batch_size=500):
+        self.model = model
+        self.column = column
+        self.interval = interval
+        self.batch_size = batch_size
+        self._pending = dict()  # 主键 => 尚未写回的增量
+        self._flushing = dict()  # 主键 => 正在写回的增量
+        self._task = None
+        self._stopping = None
+
+    def incr(self, pk, n=1):
+        self._pending[pk] = self._pending.get(pk, 0) + n
+
+    async def load(self, objs):
+        """为一组实例查询计数列（一条 where pk in (...) 查询，不使用缓存）"""
+        await self.model.loadDeferred(objs, self.column)
+
+    def views(self, obj):
+        """obj 的计数：数据库中的值加上尚未写回的增量，计数列需要已经加载"""
+        if self.column in getattr(obj, '_deferred', ()):
+            raise ValueError('%s.%s is not loaded, call load() first' % (self.model.__name__, self.column))
+        pk = obj.get(self.model.__primaryKey__)
+        return (obj.get(self.column) or 0) + self._pending.get(pk, 0) + self._flushing.get(pk, 0)
+
+    def _sql(self, n):
+        table, column, pk = self.model.__table__, self.column, self.model.__primaryKey__
+        return 'update `%s` set `%s` = `%s` + case `%s` %s end where `%s` in (%s)' % (
+            table, column, column, pk, ' '.join(['when ? then ?'] * n), pk, ', '.join(['?'] * n))
+
+    async def flush(self):
+        """把累计的增量写回数据库"""
+        if not self._pending or self._flushing:
+            return
+        self._flushing, self._pending = self._pending, dict()
+        try:
+            items = list(self._flushing.items())
+            for i in range(0, len(items), self.batch_size):
+                batch = items[i:i + self.batch_size]
+                args = [v for item in batch for v in item]
+                args.extend(pk for pk, _ in batch)
+                await execute(self._sql(len(batch)), args)
+                for pk, _ in batch:
+                    del self._flushing[pk]
+        except Exception as e:
+            logging.warning('failed to flush %s.%s, retry later: %s' % (self.model.__table__, self.column, e))
+            for pk, n in self._flushing.items():
+                self.incr(pk, n)
+        finally:
+            self._flushing = dict()
+
+    async def _run(self):
+        while not self._stopping.is_set():
+            try:
+                await asyncio.wait_for(self._stopping.wait(), self.interval)
+            except asyncio.TimeoutError:
+                await self.flush()
+
+    def start(self):
+        """启动定期写回的任务，在空的 Context 中创建，避免继承请求的截止时间等 context variable"""
+        if self._task is None:
+            self._stopping = asyncio.Event()  # 在事件循环中创建
+            self._task = contextvars.Context().run(asyncio.ensure_future, self._run())
+
+    async def stop(self):
+        """停止定期写回（等待正在进行的写回完成，不取消语句），并把剩余的增量写回"""
+        if self._task is not None:
+            self._stopping.set()
+            await self._task
+            self._task = None
+        await self.flush()
+
+
+blog_views = ViewCounter(Blog, 'views', configs.counters.flush_interval)
+
+
+async def startup(app):
+    """用于 app.on_startup"""
+    blog_views.start()
+
+
+async def shutdown(app):
+    """用于 app.on_shutdown，应用关闭时写回剩余的增量"""
+    await blog_views.stop()
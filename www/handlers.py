@@ -1,18 +1,24 @@
 """
 URL handlers
 """
+import asyncio
 import hashlib
 import json
 import logging
 import re
+import shutil
 import time
+from pathlib import Path
 
 from aiohttp import web
 
-from www.apis import APIValueError, APIError
+from www import jobs
+from www.apis import APIValueError, APIError, APIPermissionError, APIResourceNotFoundError
+from www.counters import blog_views
 from www.config import configs
-from www.coroweb import get, post
-from www.models import User, Blog, next_id
+from www.coroweb import get, post, UploadedFile
+from www.models import User, Blog, Comment, next_id, sync_user_copies
+from www.orm import DeadlineExceeded, DuplicateKeyError, gather
 
 COOKIE_NAME = 'awesession'
 _COOKIE_KEY = configs.session.secret
@@ -76,16 +82,18 @@ async def api_register_user(*, email, name, passwd):
         raise APIValueError('email')
     if not passwd or not _RE_SHA1.match(passwd):
         raise APIValueError('passwd')
-    # 查找邮箱是否已注册
-    users = await User.findAll('email=?', [email])
-    if len(users) > 0:
-        raise APIError('register:failed', 'email', 'Email is already in use.')
     # 将新用户信息存到数据库
     uid = next_id()
     sha1_passwd = '%s:%s' % (uid, passwd)  # passwd 在客户端那边已经加密过一次了，服务器这边基于它再加密一次
     user = User(id=uid, name=name.strip(), email=email, passwd=hashlib.sha1(sha1_passwd.encode('utf-8')).hexdigest(),
                 image='http://www.gravatar.com/avatar/%s?d=mm&s=120' % hashlib.md5(email.encode('utf-8')).hexdigest())
-    await user.save()
+    # 不再先查询邮箱是否已注册，直接插入，由唯一索引 idx_email 保证邮箱不重复，省去一次往返且不存在竞争
+    try:
+        await user.save()
+    except DuplicateKeyError as e:
+        if e.key == 'idx_email':
+            raise APIError('register:failed', 'email', 'Email is already in use.')
+        raise
     # 生成会话 cookie
     return _authenticate_with_cookie(user)
 
@@ -115,6 +123,71 @@ async def authenticate(*, email, passwd):
     return _authenticate_with_cookie(user)
 
 
+@get('/api/blogs/{id}')
+async def api_get_blog(*, id):
+    # 文章和评论数互不依赖，在两个连接上并发查询
+    blog, comments = await gather(Blog.find(id, only=Blog.__fields__),  # 包括延迟加载的正文和浏览次数
+                                  Comment.findNumber('count(id)', 'blog_id=?', [id]))
+    if blog is None:
+        raise APIResourceNotFoundError('blog')
+    blog.comments_count = comments
+    # 浏览次数先在内存中累加，定期批量写回；返回的次数包括尚未写回的部分
+    blog_views.incr(blog.id)
+    blog.views = blog_views.views(blog)
+    return blog
+
+
+_AVATAR_DIR = Path(__file__).resolve().parent / 'static' / 'avatars'
+
+
+def _image_ext(head):
+    """
+    按文件开头的魔数（magic bytes）判断图片类型，返回扩展名，不支持的类型返回 None
+    不使用客户端提供的 Content-Type：它可以是任意值，而文件会被公开在 /static/avatars/ 下
+    """
+    if head.startswith(b'\xff\xd8\xff'):
+        return '.jpg'
+    if head.startswith(b'\x89PNG\r\n\x1a\n'):
+        return '.png'
+    if head[:6] in (b'GIF87a', b'GIF89a'):
+        return '.gif'
+    if head[:4] == b'RIFF' and head[8:12] == b'WEBP':
+        return '.webp'
+    return None
+
+
+def _read_head(path, n=12):
+    with open(path, 'rb') as f:
+        return f.read(n)
+
+
+@post('/api/users/avatar', max_upload=configs.upload.avatar_max_size)
+async def api_upload_avatar(request, *, avatar):
+    """
+    上传头像。请求体按流式读取并写入临时文件，不会整个读入内存，超过大小限制时返回 413
+    """
+    if request.__user__ is None:
+        raise APIPermissionError('Please signin first.')
+    if not isinstance(avatar, UploadedFile):
+        raise APIValueError('avatar', 'Avatar must be a file.')
+    loop = asyncio.get_event_loop()
+    ext = _image_ext(await loop.run_in_executor(None, _read_head, avatar.path))
+    if ext is None:
+        raise APIValueError('avatar', 'Unsupported image type.')
+
+    # 移动文件可能涉及跨文件系统的复制，放到线程池中执行
+    dest = _AVATAR_DIR / ('%s%s' % (request.__user__.id, ext))
+    await loop.run_in_executor(None, lambda: _AVATAR_DIR.mkdir(parents=True, exist_ok=True))
+    await loop.run_in_executor(None, shutil.move, avatar.path, dest)
+
+    # 只更新 image 列；blogs 和 comments 中冗余的头像在后台同步
+    user = await User.find(request.__user__.id, only=['name', 'image'])
+    user.image = '/static/avatars/%s?v=%d' % (dest.name, int(time.time()))
+    await user.update()
+    jobs.enqueue_batch(sync_user_copies, user)
+    return dict(image=user.image)
+
+
 #################
 #  Help Methods #
 #################
@@ -138,7 +211,8 @@ async def _cookie2user(cookie_str):
         if len(L) == 3:
             uid, expires, sha1 = L
             if int(expires) > time.time():
-                user = await User.find(uid)
+                # 每个请求都要查询当前用户，通过缓存后端缓存，多个 worker 之间共享
+                user = await User.find(uid, cache=configs.cache_backend.session_ttl)
                 if user:
                     s = '%s-%s-%s-%s' % (uid, user.passwd, expires, _COOKIE_KEY)
                     if sha1 != hashlib.sha1(s.encode('utf-8')).hexdigest():
@@ -146,6 +220,9 @@ async def _cookie2user(cookie_str):
                     else:
                         user.passwd = '******'
                         return user
+    except (DeadlineExceeded, asyncio.CancelledError):
+        # 超时或请求被取消不是无效的 cookie，不能当作匿名用户继续处理请求（/manage/ 会被重定向到登录页而不是返回 504）
+        raise
     except Exception as e:
         logging.exception(e)
     return None
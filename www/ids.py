@@ -0,0 +1,141 @@
+"""
+主键 ID 生成器
+旧方案（LegacyIdGenerator）生成 50 个字符的字符串：15 位毫秒时间戳 + uuid4 的 hex + '000'，
+作为 varchar(50) 主键会让 InnoDB 的聚簇索引和所有二级索引（二级索引的叶子节点保存主键）变大，
+同一毫秒内的 uuid 后缀是随机的，插入位置也是随机的，会造成页分裂。
+
+SnowflakeIdGenerator 生成 64 位、按时间递增（k-sortable）的 ID，编码为 13 个字符的 base32 字符串：
+    | 41 位毫秒时间戳（自 EPOCH 起） | 10 位 worker id | 12 位序列号 |
+    - 不同进程/worker 使用不同的 worker id，生成的 ID 不会重复：
+      没有配置 worker id 时，启动时在本机的 1024 个槽位文件中用 flock 独占一个（claim_worker_id），
+      进程退出时锁自动释放；多台机器部署时为每台机器配置互不重叠的槽位范围；
+    - 同一进程内严格单调递增，时钟回拨时沿用上一次的时间戳继续递增序列号，不会阻塞；
+    - 编码使用定长的小写 Crockford base32，字符串的字典序与数值顺序一致，不包含 '-'（cookie 用 '-' 分隔字段）。
+
+通过 set_generator 切换全局的生成器，next_id 使用当前的生成器。
+"""
+
+import fcntl
+import logging
+import os
+import threading
+import time
+import uuid
+
+# 2020-01-01 00:00:00 UTC，毫秒
+EPOCH = 1577836800000
+
+_WORKER_BITS = 10
+_SEQUENCE_BITS = 12
+_MAX_WORKER = (1 << _WORKER_BITS) - 1
+_MAX_SEQUENCE = (1 << _SEQUENCE_BITS) - 1
+
+_ALPHABET = '0123456789abcdefghjkmnpqrstvwxyz'
+ID_LENGTH = 13  # 64 位 / 每个字符 5 位，向上取整
+
+
+def encode(n):
+    """将非负整数编码为定长的 base32 字符串"""
+    chars = []
+    for _ in range(ID_LENGTH):
+        chars.append(_ALPHABET[n & 31])
+        n >>= 5
+    return ''.join(reversed(chars))
+
+
+def decode(s):
+    n = 0
+    for c in s:
+        n = (n << 5) | _ALPHABET.index(c)
+    return n
+
+
+# claim_worker_id 持有锁的文件描述符，在进程的整个生命周期内保持打开
+_worker_lock_fd = None
+
+
+def claim_worker_id(lock_dir='/dev/shm/awesome-ids', start=0, stop=_MAX_WORKER + 1):
+    """
+    在 [start, stop) 中为当前进程独占一个 worker id：依次对 lock_dir 下的槽位文件加非阻塞的 flock 排他锁，
+    第一个成功的即为 worker id。锁由进程持有，进程退出（包括崩溃）时自动释放，槽位可以被新进程复用。
+    同一台机器上的进程互不重复；多台机器时为每台机器指定互不重叠的 [start, stop)
+    """
+    global _worker_lock_fd
+    if _worker_lock_fd is not None:
+        raise RuntimeError('worker id already claimed by this process')
+    os.makedirs(lock_dir, exist_ok=True)
+    for worker_id in range(start, stop):
+        fd = os.open(os.path.join(lock_dir, '%d.lock' % worker_id), os.O_RDWR | os.O_CREAT, 0o600)
+        try:
+            fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except BlockingIOError:
+            os.close(fd)
+            continue
+        _worker_lock_fd = fd
+        return worker_id
+    raise RuntimeError('no free worker id in [%d, %d) under %s' % (start, stop, lock_dir))
+
+
+class LegacyIdGenerator:
+    """旧方案：'%015d%s000' % (毫秒时间戳, uuid4 hex)，共 50 个字符"""
+
+    def __call__(self):
+        return '%015d%s000' % (int(time.time() * 1000), uuid.uuid4().hex)
+
+
+class SnowflakeIdGenerator:
+    """
+    64 位按时间递增的 ID
+    :param worker_id: 0 ~ 1023，同一时刻运行的进程之间必须互不相同；None 表示通过 claim_worker_id 独占一个
+    :param lock_dir, worker_range: 传给 claim_worker_id 的槽位目录和范围 [start, stop)
+    """
+
+    def __init__(self, worker_id=None, lock_dir='/dev/shm/awesome-ids', worker_range=(0, _MAX_WORKER + 1)):
+        if worker_id is None:
+            worker_id = claim_worker_id(lock_dir, *worker_range)
+            logging.info('id generator claimed worker id: %s' % worker_id)
+        if not 0 <= worker_id <= _MAX_WORKER:
+            raise ValueError('worker id must be between 0 and %d: %s' % (_MAX_WORKER, worker_id))
+        self.worker_id = worker_id
+        self._last = -1
+        self._sequence = 0
+        self._lock = threading.Lock()
+
+    def next_int(self):
+        with self._lock:
+            now = int(time.time() * 1000) - EPOCH
+            if now > self._last:
+                self._last = now
+                self._sequence = 0
+            else:
+                # 同一毫秒内，或时钟回拨：沿用上一次的时间戳，序列号用完就借用下一毫秒
+                self._sequence += 1
+                if self._sequence > _MAX_SEQUENCE:
+                    self._last += 1
+                    self._sequence = 0
+            return (self._last << (_WORKER_BITS + _SEQUENCE_BITS)) | (self.worker_id << _SEQUENCE_BITS) | self._sequence
+
+    def __call__(self):
+        return encode(self.next_int())
+
+
+def timestamp(id_str):
+    """从 SnowflakeIdGenerator 生成的 ID 中取出创建时间（秒）"""
+    return ((decode(id_str) >> (_WORKER_BITS + _SEQUENCE_BITS)) + EPOCH) / 1000
+
+
+# 全局的 ID 生成器，没有调用 set_generator 时在第一次使用时创建（导入模块时不占用 worker id）
+_generator = None
+
+
+def set_generator(generator):
+    """设置全局的 ID 生成器，generator 是无参数、返回字符串 ID 的可调用对象"""
+    global _generator
+    _generator = generator
+
+
+def next_id():
+    global _generator
+    if _generator is None:
+        _generator = SnowflakeIdGenerator()
+    return _generator()
@@ -0,0 +1,157 @@
+"""
+进程内的异步后台任务队列
+handler 把不需要立即完成的工作（如冗余字段的批量更新、缓存预热）放进队列后即可返回响应。
+    1. 固定数量的 worker 协程执行任务，限制并发；队列有长度上限，满了就丢弃新任务并记录日志；
+    2. enqueue_batch 把短时间内提交给同一函数的多个 item 合并为一次调用；
+    3. 任务失败时按指数退避重试；
+    4. 应用关闭时 drain：不再接受新任务，把已提交的任务执行完。
+"""
+
+import asyncio
+import contextvars
+import inspect
+import logging
+
+
+class JobQueue:
+    """
+    :param concurrency: worker 数量，即同时执行的任务数
+    :param maxsize: 队列长度上限
+    :param retries: 失败后的重试次数
+    :param retry_delay: 第一次重试前等待的秒数，之后每次翻倍
+    :param batch_size: enqueue_batch 合并的 item 数量上限，达到后立即提交
+    :param batch_delay: enqueue_batch 收集 item 的最长时间（秒）
+    :param drain_timeout: drain 时等待已提交任务的最长时间（秒），None 表示一直等待
+    """
+
+    def __init__(self, concurrency=4, maxsize=10000, retries=3, retry_delay=0.5, batch_size=100, batch_delay=0.05,
+                 drain_timeout=None):
+        self.concurrency = concurrency
+        self.drain_timeout = drain_timeout
+        self.retries = retries
+        self.retry_delay = retry_delay
+        self.batch_size = batch_size
+        self.batch_delay = batch_delay
+        self._queue = asyncio.Queue(maxsize)
+        self._workers = []
+        self._batches = dict()  # 函数 => [item 列表, 定时提交的 TimerHandle]
+        self._closed = False
+
+    def start(self):
+        """
+        启动 worker。
+        在一个空的 Context 中创建 worker，避免继承当前请求的 context variable（如请求的截止时间、追踪信息）
+        """
+        if not self._workers:
+            contextvars.Context().run(self._spawn)
+
+    def _spawn(self):
+        self._workers = [asyncio.ensure_future(self._worker()) for _ in range(self.concurrency)]
+
+    def enqueue(self, fn, *args, **kw):
+        """
+        提交任务 fn(*args, **kw)，fn 可以是协程函数或普通函数
+        :return: 是否提交成功，队列已满或已关闭时返回 False
+        """
+        if self._closed:
+            logging.warning('job queue is closed, drop job: %s' % fn.__name__)
+            return False
+        self.start()
+        try:
+            self._queue.put_nowait((fn, args, kw))
+        except asyncio.QueueFull:
+            logging.warning('job queue is full, drop job: %s' % fn.__name__)
+            return False
+        return True
+
+    def enqueue_batch(self, fn, item):
+        """
+        提交 item，与 batch_delay 时间内提交给同一个 fn 的其他 item 合并为一次 fn(items) 调用
+        """
+        if self._closed:
+            logging.warning('job queue is closed, drop job: %s' % fn.__name__)
+            return False
+        batch = self._batches.get(fn)
+        if batch is None:
+            timer = asyncio.get_event_loop().call_later(self.batch_delay, self._flush, fn)
+            batch = self._batches[fn] = [[], timer]
+        batch[0].append(item)
+        if len(batch[0]) >= self.batch_size:
+            self._flush(fn)
+        return True
+
+    def _flush(self, fn):
+        batch = self._batches.pop(fn, None)
+        if batch is not None:
+            items, timer = batch
+            timer.cancel()
+            self.enqueue(fn, items)
+
+    async def _worker(self):
+        while True:
+            fn, args, kw = await self._queue.get()
+            try:
+                await self._run(fn, args, kw)
+            finally:
+                self._queue.task_done()
+
+    async def _run(self, fn, args, kw):
+        for attempt in range(self.retries + 1):
+            try:
+                r = fn(*args, **kw)
+                if inspect.isawaitable(r):
+                    await r
+                return
+            except Exception as e:
+                if attempt == self.retries:
+                    logging.exception('job %s failed after %d attempts: %s' % (fn.__name__, attempt + 1, e))
+                    return
+                delay = self.retry_delay * 2 ** attempt
+                logging.warning('job %s failed, retry in %.1fs: %s' % (fn.__name__, delay, e))
+                await asyncio.sleep(delay)
+
+    async def drain(self):
+        """不再接受新任务，等待已提交的任务执行完（最多 drain_timeout 秒），然后停止 worker"""
+        for fn in list(self._batches):
+            self._flush(fn)
+        self._closed = True
+        logging.info('drain job queue: %d pending jobs' % self._queue.qsize())
+        try:
+            await asyncio.wait_for(self._queue.join(), self.drain_timeout)
+        except asyncio.TimeoutError:
+            logging.warning('job queue drain timed out, %d jobs dropped' % self._queue.qsize())
+        for w in self._workers:
+            w.cancel()
+        await asyncio.gather(*self._workers, return_exceptions=True)
+        self._workers = []
+
+
+# 全局任务队列，由 init 按配置创建
+_queue = None
+
+
+def init(**kw):
+    global _queue
+    _queue = JobQueue(**kw)
+    return _queue
+
+
+def _get_queue():
+    global _queue
+    if _queue is None:
+        _queue = JobQueue()
+    return _queue
+
+
+def enqueue(fn, *args, **kw):
+    return _get_queue().enqueue(fn, *args, **kw)
+
+
+def enqueue_batch(fn, item):
+    return _get_queue().enqueue_batch(fn, item)
+
+
+async def shutdown(app):
+    """应用关闭时 drain 全局任务队列，用于 app.on_shutdown"""
+    if _queue is not None:
+        await _queue.drain()
@@ -1,11 +1,7 @@
 import time
-import uuid
 
-from www.orm import Model, StringField, BooleanField, FloatField, TextField
-
-
-def next_id():
-    return '%015d%s000' % (int(time.time() * 1000), uuid.uuid4().hex)
+from www.ids import next_id
+from www.orm import execute, invalidate, Model, IdField, StringField, BooleanField, IntegerField, FloatField, TextField
 
 
 class User(Model):
@@ -18,8 +14,9 @@ class User(Model):
     实例属性可以在新建实例对象后，调用一次 save() 来自动初始化/绑定。
     """
     __table__ = 'users'
+    __cache_rows__ = True  # 会话用户通过 find(cache=...) 缓存，见 handlers._cookie2user
 
-    id = StringField(primary_key=True, default=next_id, ddl='varchar(50)')
+    id = IdField(primary_key=True)
     email = StringField(ddl='varchar(50)')
     passwd = StringField(ddl='varchar(50)')
     admin = BooleanField()
@@ -32,23 +29,40 @@ class User(Model):
 class Blog(Model):
     __table__ = 'blogs'
 
-    id = StringField(primary_key=True, default=next_id, ddl='varchar(50)')
-    user_id = StringField(ddl='varchar(50)')
+    id = IdField(primary_key=True)
+    user_id = IdField(references='User')  # Blog.user，User.blogs
     user_name = StringField(ddl='varchar(50)')
     user_image = StringField(ddl='varchar(500)')
     name = StringField(ddl='varchar(50)')
     summary = StringField(ddl='varchar(200)')
-    content = TextField()
+    content = TextField(lazy=True)  # 列表页只需要 name 和 summary，正文按需加载
+    # 浏览次数，由 counters.blog_views 批量写回。延迟加载，不进入缓存的查询结果（缓存中的计数在写回后会变小），
+    # 需要时用 blog_views.load 批量查询；也避免 update 用旧的计数覆盖写回的增量
+    views = IntegerField(lazy=True)
     created_at = FloatField(default=time.time)
 
 
 class Comment(Model):
     __table__ = 'comments'
 
-    id = StringField(primary_key=True, default=next_id, ddl='varchar(50)')
-    blog_id = StringField(ddl='varchar(50)')
-    user_id = StringField(ddl='varchar(50)')
+    id = IdField(primary_key=True)
+    blog_id = IdField(references='Blog')  # Comment.blog，Blog.comments
+    user_id = IdField(references='User')  # Comment.user，User.comments
     user_name = StringField(ddl='varchar(50)')
     user_image = StringField(ddl='varchar(500)')
     content = TextField()
     created_at = FloatField(default=time.time)
+
+
+async def sync_user_copies(users):
+    """
+    blogs 和 comments 冗余保存了作者的 user_name 和 user_image，用户资料修改后需要同步这些副本。
+    行数可能很多，应放到后台任务队列执行：jobs.enqueue_batch(sync_user_copies, user)，
+    同一批次内同一用户多次修改只同步最后一次。
+    """
+    latest = {u.id: u for u in users}
+    for model in (Blog, Comment):
+        sql = 'update `%s` set `user_name`=?, `user_image`=? where `user_id`=?' % model.__table__
+        for u in latest.values():
+            await execute(sql, [u.name, u.image, u.id])
+        invalidate(model.__table__)
@@ -1,32 +1,369 @@
 """
 1. 创建全局数据库连接池的方法：create_pool
 2. 提供数据库查询、修改操作接口：select、execute
+    支持请求级别的截止时间（deadline），超时的语句会在服务端被 KILL QUERY 取消；
+    gather 在不同的连接上并发执行多个互不依赖的查询，并限制一个请求同时占用的连接数
 3. 存储列信息的基本类型 Field 和其衍生类型
 4. 存储行信息的类型 Model 类型。
     通过 metaclass 机制管理表格信息（表名、包含的列的名称和类型）；
-    提供异步的数据库查找、更新、存储、移除方法。
+    提供异步的数据库查找、更新、存储、移除方法；
+    支持按需查询部分列（only/defer），未查询的列可以按需批量加载（load、loadDeferred）。
 5. 存储表信息的类型 ModelMetaClass.
     提供通用的用户自定义类的创建方法，从 Model 子类的 attributes 中将列名和Field对象作为字典管理，并生成 SQL 语句模版；
     提供为类实例自动补全带默认值的列属性的方法：getValueOrDefault
 """
 
+import asyncio
+import contextlib
+import contextvars
 import logging
+import re
+import time
+import uuid
+import weakref
 
 import aiomysql
 
+from www import ids, tracing
+from www.cache import get_backend
+
 # 全局数据库连接池
 _pool = None
+# 查询结果缓存（www.cache.QueryCache），通过 set_query_cache 开启
+_query_cache = None
+# 用于 KILL QUERY 的旁路连接参数，与连接池相同
+_connect_kw = None
+# 空闲超过该时间（秒）的连接在使用前先 ping，None 表示不检查
+_ping_idle = None
+# 连接上次归还连接池的时间，用于判断空闲时间
+_released_at = weakref.WeakKeyDictionary()
+# 连接的最长使用时间（秒），None 表示不限制；连接第一次被取出的时间，用于判断使用时间
+_max_lifetime = None
+_first_used_at = weakref.WeakKeyDictionary()
+# 自适应的并发连接数上限，见 create_pool 的 adaptive 参数
+_limit = None
+# gather 中一个请求最多同时占用的连接数，见 create_pool 的 request_connections 参数
+_request_connections = None
+
+# 当前请求的截止时间（loop.time() 的时间点），由 middleware 设置，select 和 execute 共同遵守
+_deadline = contextvars.ContextVar('deadline', default=None)
+# KILL QUERY 之后，等待被中断的语句返回的最长时间（秒），超时则关闭该连接
+_KILL_GRACE = 1.0
+# 当前请求的连接预算（asyncio.Semaphore），由 gather 设置，其中的查询共享
+_budget = contextvars.ContextVar('connection_budget', default=None)
+
+
+class DeadlineExceeded(Exception):
+    """请求的截止时间已过，数据库操作被取消"""
+    pass
+
+
+class DuplicateKeyError(Exception):
+    """
+    违反主键或唯一索引约束（MySQL 错误码 1062）
+    key 为冲突的索引名，如 idx_email、PRIMARY
+    """
+
+    def __init__(self, key, message=''):
+        super(DuplicateKeyError, self).__init__(message)
+        self.key = key
+
+
+_ER_DUP_ENTRY = 1062
+_RE_DUP_KEY = re.compile(r"for key '(?:[^']*\.)?([^'.]+)'")
+
+
+def set_deadline(timeout):
+    """
+    为当前上下文（请求）设置截止时间，返回的 token 用于 reset_deadline 恢复
+    :param timeout: 从现在开始的秒数
+    """
+    return _deadline.set(asyncio.get_event_loop().time() + timeout)
+
+
+def reset_deadline(token):
+    _deadline.reset(token)
+
+
+def _remaining():
+    """距离截止时间的剩余秒数，没有设置截止时间时返回 None"""
+    deadline = _deadline.get()
+    if deadline is None:
+        return None
+    remaining = deadline - asyncio.get_event_loop().time()
+    if remaining <= 0:
+        raise DeadlineExceeded('deadline exceeded before query')
+    return remaining
+
+
+class _WaitStats:
+    """
+    统计从连接池获取连接的等待时间，用于判断连接池是否饱和
+    - 已完成的等待用指数加权移动平均（EWMA）记录，并随时间衰减，避免没有新查询时数值一直居高不下
+    - 正在等待中的请求按最早开始等待的时间计算
+    """
+
+    def __init__(self, alpha=0.2, half_life=5.0):
+        self.alpha = alpha
+        self.half_life = half_life
+        self.average = 0.0
+        self.updated_at = time.monotonic()
+        self.waiting = dict()
+
+    def begin(self, token):
+        self.waiting[token] = time.monotonic()
+
+    def end(self, token):
+        now = time.monotonic()
+        waited = now - self.waiting.pop(token, now)
+        self.average = self.alpha * waited + (1 - self.alpha) * self._decayed(now)
+        self.updated_at = now
+        return waited
+
+    def _decayed(self, now):
+        return self.average * 0.5 ** ((now - self.updated_at) / self.half_life)
+
+    def current(self):
+        now = time.monotonic()
+        oldest = min(self.waiting.values(), default=now)
+        return max(self._decayed(now), now - oldest)
+
+
+_wait_stats = _WaitStats()
+
+
+class _AdaptiveLimit:
+    """
+    根据获取连接的等待时间，在 [low, high] 之间调整同时使用的连接数上限
+    等待时间超过 grow_wait 时加一，低于 shrink_wait 且有空余时减一，每 interval 秒最多调整一次。
+    连接池本身的 maxsize 设为 high，多出的空闲连接由 pool_recycle 逐渐回收。
+    """
+
+    def __init__(self, low, high, grow_wait=0.05, shrink_wait=0.005, interval=5.0):
+        self.limit = low
+        self.low = low
+        self.high = high
+        self.grow_wait = grow_wait
+        self.shrink_wait = shrink_wait
+        self.interval = interval
+        self.in_use = 0
+        self._adjusted_at = time.monotonic()
+        self._cond = asyncio.Condition()
+
+    async def acquire(self):
+        async with self._cond:
+            await self._cond.wait_for(lambda: self.in_use < self.limit)
+            self.in_use += 1
+
+    async def release(self):
+        async with self._cond:
+            self.in_use -= 1
+            self._cond.notify()
+
+    async def adjust(self, wait):
+        now = time.monotonic()
+        if now - self._adjusted_at < self.interval:
+            return
+        self._adjusted_at = now
+        if wait > self.grow_wait and self.limit < self.high:
+            self.limit += 1
+            logging.info('grow connection limit to %s (acquire wait %.3fs)' % (self.limit, wait))
+            async with self._cond:
+                self._cond.notify()
+        elif wait < self.shrink_wait and self.in_use < self.limit - 1 and self.limit > self.low:
+            self.limit -= 1
+            logging.info('shrink connection limit to %s (acquire wait %.3fs)' % (self.limit, wait))
+
+
+def pool_wait():
+    """当前获取数据库连接的等待时间（秒）"""
+    return _wait_stats.current()
+
+
+async def _acquire_checked():
+    """
+    从连接池获取一个可用的连接
+    - 使用时间超过 _max_lifetime 的连接关闭并换一个（aiomysql 的 pool_recycle 只回收空闲的连接，繁忙的连接永远不会被回收）；
+    - 空闲时间超过 _ping_idle 的连接先 ping（断开时自动重连），失败就关闭并换一个，
+      避免 MySQL 故障切换后第一次查询因为旧连接失效而失败
+    """
+    while True:
+        conn = await _pool.acquire()
+        now = time.monotonic()
+        first_used_at = _first_used_at.setdefault(conn, now)
+        if _max_lifetime is not None and now - first_used_at >= _max_lifetime:
+            conn.close()
+            await _pool.release(conn)
+            logging.info('recycle connection after %.0fs' % (now - first_used_at))
+            continue
+        released_at = _released_at.get(conn)
+        if _ping_idle is None or released_at is None or time.monotonic() - released_at < _ping_idle:
+            return conn
+        try:
+            await conn.ping()
+            return conn
+        except BaseException as e:
+            conn.close()
+            await _pool.release(conn)
+            if not isinstance(e, Exception):
+                raise
+            logging.warning('drop stale connection: %s' % e)
+
+
+@contextlib.asynccontextmanager
+async def _acquire():
+    """从连接池获取连接，并记录等待时间"""
+    # 先取得请求的连接预算（见 gather）：等待同一请求中其他查询释放连接不是连接池的等待，不计入等待时间，
+    # 否则一个并发查询很多的页面会让 pool_wait() 升高，导致准入控制拒绝所有请求、自适应上限无故增长
+    budget = _budget.get()
+    if budget is not None:
+        try:
+            await asyncio.wait_for(budget.acquire(), _remaining())
+        except asyncio.TimeoutError:
+            raise DeadlineExceeded('deadline exceeded while waiting for connection budget')
+    token = object()
+    _wait_stats.begin(token)
+    limited = False
+    try:
+        with tracing.span('pool'):
+            if _limit is not None:
+                await asyncio.wait_for(_limit.acquire(), _remaining())
+                limited = True
+            conn = await asyncio.wait_for(_acquire_checked(), _remaining())
+    except BaseException as e:
+        if limited:
+            await _limit.release()
+        if budget is not None:
+            budget.release()
+        if isinstance(e, asyncio.TimeoutError):
+            raise DeadlineExceeded('deadline exceeded while waiting for connection')
+        raise
+    finally:
+        waited = _wait_stats.end(token)
+    if _limit is not None:
+        await _limit.adjust(waited)
+    try:
+        yield conn
+    finally:
+        _released_at[conn] = time.monotonic()
+        await _pool.release(conn)
+        if _limit is not None:
+            await _limit.release()
+        if budget is not None:
+            budget.release()
+
+
+async def gather(*aws):
+    """
+    在不同的连接上并发执行多个互不依赖的查询，按顺序返回结果，如：
+        blog, num = await gather(Blog.find(id), Comment.findNumber('count(id)', 'blog_id=?', [id]))
+    - 同一个请求中（包括嵌套的 gather）同时占用的连接数不超过 request_connections，避免一个页面占满连接池；
+    - 一个查询失败时取消其他尚未完成的查询（正在执行的语句在服务端被 KILL QUERY），再抛出该异常；
+    - 查询继承当前的截止时间。
+    """
+    token = None
+    if _budget.get() is None and _request_connections:
+        token = _budget.set(asyncio.Semaphore(_request_connections))
+    try:
+        tasks = [asyncio.ensure_future(aw) for aw in aws]  # task 创建时复制当前 Context，共享同一个预算
+    finally:
+        if token is not None:
+            _budget.reset(token)
+    if not tasks:
+        return []
+    try:
+        done, pending = await asyncio.wait(tasks, return_when=asyncio.FIRST_EXCEPTION)
+    except asyncio.CancelledError:
+        pending = tasks
+        raise
+    finally:
+        for t in pending:
+            t.cancel()
+        if pending:
+            await asyncio.gather(*pending, return_exceptions=True)
+    # 取出所有失败查询的异常（避免 Task exception was never retrieved），抛出第一个
+    errors = [t.exception() for t in tasks if not t.cancelled() and t.exception() is not None]
+    if errors:
+        raise errors[0]
+    return [t.result() for t in tasks]
 
 
 def log(sql):
     logging.info('SQL: %s' % sql)
 
 
+async def _kill_query(thread_id):
+    """通过一条旁路连接在服务端取消 thread_id 对应连接上正在执行的语句"""
+    logging.warning('kill query on connection %s' % thread_id)
+    try:
+        conn = await aiomysql.connect(**_connect_kw)
+        try:
+            async with conn.cursor() as cur:
+                await cur.execute('KILL QUERY %d' % thread_id)
+        finally:
+            conn.close()
+    except Exception as e:
+        logging.exception(e)
+
+
+def _abandon(conn):
+    """语句执行中被取消：连接状态不确定，直接关闭（连接池会丢弃已关闭的连接），并在后台 KILL QUERY"""
+    thread_id = conn.thread_id()
+    conn.close()
+    asyncio.ensure_future(_kill_query(thread_id))
+
+
+async def _execute(conn, cur, sql, args):
+    """
+    在截止时间内执行语句。
+    超时或请求被取消（如客户端断开）时，在服务端取消该语句：
+        - 超时：KILL QUERY 后等待语句以中断错误返回，连接可以正常归还连接池，再抛出 DeadlineExceeded；
+        - 取消：连接状态不确定，直接关闭（连接池会丢弃已关闭的连接），并在后台 KILL QUERY。
+    """
+    remaining = _remaining()
+    if remaining is None:
+        try:
+            await cur.execute(sql, args)
+        except asyncio.CancelledError:
+            _abandon(conn)
+            raise
+        return
+    task = asyncio.ensure_future(cur.execute(sql, args))
+    try:
+        done, _ = await asyncio.wait({task}, timeout=remaining)
+    except asyncio.CancelledError:
+        task.cancel()
+        _abandon(conn)
+        raise
+    if task in done:
+        task.result()
+        return
+    await _kill_query(conn.thread_id())
+    try:
+        await asyncio.wait_for(task, _KILL_GRACE)
+    except asyncio.TimeoutError:
+        conn.close()
+    except Exception:
+        pass  # 被中断的语句会返回 Query execution was interrupted
+    raise DeadlineExceeded('deadline exceeded, query killed: %s' % sql)
+
+
 async def create_pool(**kw):
+    """
+    创建连接池，创建时即建立 minsize 个连接（预热），避免启动后的第一批请求等待建立连接
+    :param minsize: 连接池保持的最少连接数
+    :param maxsize: 同时使用的最多连接数
+    :param pool_recycle: 连接的最长空闲时间（秒），取出时空闲超过该时间的连接关闭重建，-1 表示不回收
+    :param max_lifetime: 连接的最长使用时间（秒），从第一次被取出开始计算，超过后在下一次取出时关闭重建，None 表示不限制
+    :param ping_idle: 空闲超过该时间（秒）的连接在使用前先 ping，None 表示不检查
+    :param adaptive: 自适应调整连接数上限的配置，如 dict(max=30, grow_wait=0.05, shrink_wait=0.005, interval=5)，
+        上限在 [maxsize, max] 之间，根据获取连接的等待时间调整；None 表示不调整
+    :param request_connections: gather 中一个请求最多同时占用的连接数，None 表示不限制
+    """
     logging.info('create database connection pool...')
 
-    global _pool  # 声明_pool是全局变量
-    _pool = await aiomysql.create_pool(
+    global _pool, _connect_kw, _ping_idle, _max_lifetime, _limit, _request_connections  # 声明_pool是全局变量
+    _connect_kw = dict(
         host=kw.get('host', 'localhost'),
         port=kw.get('port', 3306),
         user=kw['user'],
@@ -34,19 +371,69 @@ async def create_pool(**kw):
         db=kw['db'],
         charset=kw.get('charset', 'utf8'),
         autocommit=kw.get('autocommit', True),
-        maxsize=kw.get('maxsize', 10),
-        minsize=kw.get('minsize', 1),
+        connect_timeout=kw.get('connect_timeout', 10),
     )
+    minsize = kw.get('minsize', 1)
+    maxsize = kw.get('maxsize', 10)
+    adaptive = kw.get('adaptive', None)
+    if adaptive:
+        high = max(adaptive.get('max', maxsize * 2), maxsize)
+        _limit = _AdaptiveLimit(maxsize, high, adaptive.get('grow_wait', 0.05), adaptive.get('shrink_wait', 0.005),
+                                adaptive.get('interval', 5.0))
+        maxsize = high
+    else:
+        _limit = None
+    _ping_idle = kw.get('ping_idle', None)
+    _max_lifetime = kw.get('max_lifetime', None)
+    _request_connections = kw.get('request_connections', None)
+    _pool = await aiomysql.create_pool(
+        maxsize=maxsize,
+        minsize=minsize,
+        pool_recycle=kw.get('pool_recycle', -1),
+        **_connect_kw
+    )
+    logging.info('database connection pool ready: %s connections' % _pool.size)
+
+
+def set_query_cache(cache):
+    """设置查询结果缓存，findAll 和 findNumber 通过 cache 参数选择使用"""
+    global _query_cache
+    _query_cache = cache
+
+
+async def _cached_select(tag, sql, args, size=None, ttl=None):
+    """
+    查询并缓存结果，以表名 tag 作为缓存的标签
+    :param ttl: None 表示不使用缓存；True 表示使用默认过期时间；数字表示过期时间（秒）
+    """
+    if ttl is None or ttl is False or _query_cache is None:
+        return await select(sql, args, size)
+    key = (sql, tuple(args or ()), size)
+    rs = _query_cache.get(key)
+    if rs is not None:
+        logging.info('SQL (cached): %s' % sql)
+        return rs
+    version = _query_cache.version(tag)
+    rs = await select(sql, args, size)
+    _query_cache.set(key, rs, tag, version, None if ttl is True else ttl)
+    return rs
+
+
+def invalidate(tag):
+    """表 tag 有写操作，使其缓存的查询结果失效。直接调用 execute 写表后，需要手动调用"""
+    if _query_cache is not None:
+        _query_cache.invalidate(tag)
 
 
 async def select(sql, args, size=None):
     log(sql)
 
-    async with _pool.acquire() as conn:
+    async with _acquire() as conn:
         async with conn.cursor(aiomysql.DictCursor) as cur:
             # SQL 与 MySQL 占位符不同
             # 使用带参数的 SQL 而不是自己拼接，可以防止SQL注入攻击
-            await cur.execute(sql.replace('?', '%s'), args or ())
+            with tracing.sql_span(sql):
+                await _execute(conn, cur, sql.replace('?', '%s'), args or ())
             if size:
                 rs = await cur.fetchmany(size)
             else:
@@ -61,19 +448,23 @@ async def execute(sql, args, autocommit=True):
     """
     log(sql)
 
-    async with _pool.acquire() as conn:
+    async with _acquire() as conn:
         if not autocommit:
             # 不想使用autocommit，需要开启事务transaction，保证操作要么全部执行，要么都不执行
             await conn.begin()
         try:
             async with conn.cursor(aiomysql.DictCursor) as cur:
-                await cur.execute(sql.replace('?', '%s'), args)
+                with tracing.sql_span(sql):
+                    await _execute(conn, cur, sql.replace('?', '%s'), args)
                 affected = cur.rowcount
             if not autocommit:
                 await conn.commit()  # 不 autocommit，就要显式调用该方法，将修改写入数据库
         except Exception as e:
-            if not autocommit:
+            if not autocommit and not conn.closed:
                 await conn.rollback()  # commit 出错需要执行回滚
+            if isinstance(e, aiomysql.IntegrityError) and e.args and e.args[0] == _ER_DUP_ENTRY:
+                m = _RE_DUP_KEY.search(str(e.args[-1]))
+                raise DuplicateKeyError(m.group(1) if m else None, str(e.args[-1])) from e
             raise
         return affected
 
@@ -84,18 +475,20 @@ async def execute(sql, args, autocommit=True):
 
 
 class Field:
-    def __init__(self, name, column_type, primary_key, default):
+    def __init__(self, name, column_type, primary_key, default, lazy=False):
         """
         保存数据库表的字段名和字段类型等信息
         :param name: 列名
         :param column_type: 数据类型
         :param primary_key: 是否为主键
         :param default: 默认值
+        :param lazy: 是否为延迟加载的列，默认的 SELECT 语句不包含该列，需要时再按需加载
         """
         self.name = name
         self.column_type = column_type
         self.primary_key = primary_key
         self.default = default
+        self.lazy = lazy
 
     def __str__(self):
         return '<%s, %s:%s>' % (self.__class__.__name__, self.column_type, self.name)
@@ -106,14 +499,36 @@ class StringField(Field):
         super().__init__(name, ddl, primary_key, default)
 
 
+class IdField(Field):
+    """
+    www.ids 生成的定长、按时间递增的字符串 ID，用作主键或引用其他表主键的列
+    作为主键时默认使用 ids.next_id 生成
+    """
+
+    def __init__(self, name=None, primary_key=False, default=None, ddl='char(%d)' % ids.ID_LENGTH, references=None,
+                 related_name=None, relation_name=None):
+        """
+        :param references: 引用的 Model 类名，如 Blog.user_id 引用 'User'，声明后可以用 prefetch 批量加载关联的行
+        :param related_name: 被引用的 Model 上反向关联的名称，默认为当前 Model 的表名，如 User.blogs
+        :param relation_name: 当前 Model 上正向关联的名称，默认为去掉 _id 后缀的列名，如 Blog.user；
+            列名不以 _id 结尾时必须指定
+        """
+        if primary_key and default is None:
+            default = ids.next_id
+        super().__init__(name, ddl, primary_key, default)
+        self.references = references
+        self.related_name = related_name
+        self.relation_name = relation_name
+
+
 class BooleanField(Field):
     def __init__(self, name=None, default=False):
         super().__init__(name, 'boolean', False, default)
 
 
 class IntegerField(Field):
-    def __init__(self, name=None, primary_key=False, default=0):
-        super().__init__(name, 'bigint', primary_key, default)
+    def __init__(self, name=None, primary_key=False, default=0, lazy=False):
+        super().__init__(name, 'bigint', primary_key, default, lazy)
 
 
 class FloatField(Field):
@@ -122,8 +537,8 @@ class FloatField(Field):
 
 
 class TextField(Field):
-    def __init__(self, name=None, default=None):
-        super().__init__(name, 'text', False, default)
+    def __init__(self, name=None, default=None, lazy=False):
+        super().__init__(name, 'text', False, default, lazy)
 
 
 def _create_args_string(num):
@@ -131,6 +546,64 @@ def _create_args_string(num):
     return ', '.join(L)
 
 
+def _in_args_string(num):
+    """生成 IN (...) 子句中的 num 个占位符"""
+    return ', '.join(['?'] * num)
+
+
+def _compile_fast_paths(model):
+    """
+    为 Model 子类生成专用的函数，省去逐列的 getattr、__getattr__ 的异常处理和 __mappings__ 查找：
+    - __insert_args__(self): INSERT 的参数列表，列的默认值直接内联在代码中
+    - __update_args__(self): 更新全部列的 UPDATE 的参数列表
+    - __from_row__(row, deferred): 由查询结果直接构造实例，不经过 __init__ 的关键字参数解包
+    """
+    columns = model.__fields__ + [model.__primaryKey__]
+    ns = dict(_cls=model, _new=dict.__new__, _fill=dict.update)
+
+    lines = ['def __insert_args__(self):', '    get = self.get']
+    for i, f in enumerate(columns):
+        lines.append(f'    v{i} = get({f!r})')
+        default = model.__mappings__[f].default
+        if default is not None:
+            # 与 getValueOrDefault 相同：值为 None 时取默认值，并写回实例
+            ns[f'_d{i}'] = default
+            lines.append(f'    if v{i} is None:')
+            lines.append(f'        v{i} = self[{f!r}] = _d{i}()' if callable(default) else
+                         f'        v{i} = self[{f!r}] = _d{i}')
+    lines.append('    return [%s]' % ', '.join(f'v{i}' for i in range(len(columns))))
+
+    lines.append('def __update_args__(self):')
+    lines.append('    get = self.get')
+    lines.append('    return [%s]' % ', '.join(f'get({f!r})' for f in columns))
+
+    lines.append('def __from_row__(row, deferred):')
+    lines.append('    obj = _new(_cls)')
+    lines.append('    _fill(obj, row)')
+    lines.append('    d = obj.__dict__')
+    lines.append('    d["_dirty"] = set()')
+    lines.append('    if deferred:')
+    lines.append('        d["_deferred"] = deferred')
+    lines.append('    return obj')
+
+    exec('\n'.join(lines), ns)
+    model.__insert_args__ = ns['__insert_args__']
+    model.__update_args__ = ns['__update_args__']
+    model.__from_row__ = staticmethod(ns['__from_row__'])
+
+
+# Model.find 缓存的行的代：key 为 _ROW_GENERATION % 行的缓存 key，值为每次写操作生成的随机字符串，
+# 只有 __cache_rows__ 为 True 的 Model 才会写入代，其他 Model 的写操作不访问缓存后端。
+# 代只需要在一次查询期间保持有效（过期后前后两次读到的都是 None，不影响判断），过期时间远大于查询时间即可
+_ROW_GENERATION = 'gen:%s'
+_ROW_GENERATION_TTL = 3600
+
+# 所有 Model 子类，类名 => 类，用于解析 IdField 的 references
+_models = dict()
+# IdField 声明的引用关系：(Model 类, 列名, 引用的类名, 正向关联名, 反向关联名)
+_references = list()
+
+
 class ModelMetaclass(type):
     def __new__(cls, name, bases, attrs):
         # 排除Model类本身，只处理用户自定义的类（Model的子类）
@@ -142,7 +615,7 @@ class ModelMetaclass(type):
         logging.info('found model: %s (table: %s)' % (name, tableName))
 
         # 获取所有的Field和主键名
-        mappings, fields, primaryKey = dict(), list(), None
+        mappings, fields, lazyFields, primaryKey = dict(), list(), list(), None
         for k, v in attrs.items():  # k 是变量名，v 是 Field 对象
             if isinstance(v, Field):
                 logging.info('  found mapping: %s ==> %s' % (k, v))
@@ -155,6 +628,8 @@ class ModelMetaclass(type):
                     primaryKey = k
                 else:
                     fields.append(k)
+                    if v.lazy:
+                        lazyFields.append(k)
 
         if not primaryKey:
             raise Exception('Primary key not found.')
@@ -172,21 +647,67 @@ class ModelMetaclass(type):
         attrs['__table__'] = tableName
         attrs['__primaryKey__'] = primaryKey  # 主键属性名
         attrs['__fields__'] = fields  # 除主键外的属性名
+        attrs['__lazy_fields__'] = lazyFields  # 默认延迟加载的属性名
+        attrs['__select_cache__'] = dict()  # 按列集合缓存 SELECT 语句
+        attrs['__update_cache__'] = dict()  # 按列集合缓存 UPDATE 语句
         # 构造默认的SELECT, INSERT, UPDATE和DELETE语句，后面的数据库操作方法根据这里的定义准备数据
         # 把列名和等待填充的参数（用"?"占位）加进语句里
-        attrs['__select__'] = f'select `{primaryKey}`, {escaped_fields_str} from `{tableName}`'
+        # 默认的 SELECT 语句不包含延迟加载的列
+        selected_str = ', '.join('`%s`' % f for f in fields if f not in lazyFields)
+        attrs['__select__'] = f'select `{primaryKey}`{", " if selected_str else ""}{selected_str} from `{tableName}`'
         attrs[
             '__insert__'] = f'insert into `{tableName}` ({escaped_fields_str}, `{primaryKey}`) values ({_create_args_string(len(escaped_fields))})'
+        # 冲突时忽略（INSERT IGNORE）或改为更新（INSERT ... ON DUPLICATE KEY UPDATE）
+        attrs['__insert_ignore__'] = attrs['__insert__'].replace('insert into', 'insert ignore into', 1)
+        attrs['__upsert_cache__'] = dict()  # 按冲突时更新的列集合缓存 upsert 语句
         attrs['__update__'] = f'update `{tableName}` set {update_str} where `{primaryKey}`=?'
         attrs['__delete__'] = f'delete from `{tableName}` where `{primaryKey}`=?'
 
-        return type.__new__(cls, name, bases, attrs)
+        model = type.__new__(cls, name, bases, attrs)
+        _compile_fast_paths(model)
+        refs = []
+        for k, v in mappings.items():
+            references = getattr(v, 'references', None)
+            if references:
+                # 正向关联名默认去掉列名的 _id 后缀，如 user_id => user。
+                # prefetch 把关联的实例放在实例的 __dict__ 中，与列同名时会遮住列的值，所以不能与列同名
+                forward = v.relation_name or (k[:-3] if k.endswith('_id') else None)
+                if forward is None:
+                    raise ValueError('relation_name is required for %s.%s (column does not end with _id)' % (name, k))
+                if forward in mappings:
+                    raise ValueError('relation name %s of %s.%s collides with a field' % (forward, name, k))
+                refs.append((model, k, references, forward, v.related_name or tableName))
+        # 检查通过后再注册，避免定义失败的 Model 留在注册表中
+        _models[name] = model
+        _references.extend(refs)
+        return model
 
 
 class Model(dict, metaclass=ModelMetaclass):  # 继承 dict，支持字典的读写语法
+    # 当前实例中尚未从数据库加载的列（延迟加载），见 findAll 的 only/defer 参数
+    _deferred = frozenset()
+    # 自从数据库加载或保存以来被修改过的列，update 只写这些列
+    # None 表示实例不是从数据库加载的，无法得知哪些列被修改过，update 写全部列
+    _dirty = None
+    # 是否允许 find(cache=...) 通过缓存后端缓存行；开启后每次写操作都要更新行的代并删除缓存（两次后端访问），
+    # 所以只为读多写少、需要跨 worker 缓存的 Model（如会话用户）开启
+    __cache_rows__ = False
+
     def __init__(self, **kw):
         super(Model, self).__init__(**kw)
 
+    def __setitem__(self, key, value):
+        super(Model, self).__setitem__(key, value)
+        if key in self._deferred:
+            # 手动赋值后，该列不再视为未加载
+            self.__dict__['_deferred'] = self._deferred - {key}
+        if self._dirty is not None:
+            self._dirty.add(key)
+
+    def _markClean(self):
+        """将当前实例标记为与数据库一致（刚加载或刚保存）"""
+        self.__dict__['_dirty'] = set()
+
     # 实现特殊方法 __getattr__()和__setattr__()，使其支持通过 "." 引用字段或新增字段
     # 仅当属性不能在实例的__dict__或它的类(类的__dict__),或父类的__dict__中找到时，才被调用
     # 必须抛出 AttributeError，getattr 方法在有默认值时才能正确处理
@@ -194,10 +715,12 @@ class Model(dict, metaclass=ModelMetaclass):  # 继承 dict，支持字典的读
         try:
             return self[key]
         except KeyError:
+            if key in self._deferred:
+                raise AttributeError(r"deferred field '%s' is not loaded, call load() first" % key)
             raise AttributeError(r"'Model' object has no attribute '%s'" % key)
 
     def __setattr__(self, key, value):
-        self[key] = value
+        self[key] = value  # 通过 __setitem__ 记录被修改的列
 
     def getValue(self, key):
         """
@@ -222,13 +745,72 @@ class Model(dict, metaclass=ModelMetaclass):  # 继承 dict，支持字典的读
                 setattr(self, key, value)
         return value
 
+    # 延迟加载
+    @classmethod
+    def _selectColumns(cls, only=None, defer=None):
+        """
+        根据 only/defer 计算要查询的列，返回 (SELECT 语句, 未加载的列)
+        - only: 只查询这些列（主键总会被查询）
+        - defer: 在默认延迟列（lazy=True）之外，额外不查询的列
+        """
+        if only is not None:
+            columns = [f for f in cls.__fields__ if f in only]
+        else:
+            deferred = set(cls.__lazy_fields__)
+            if defer:
+                deferred.update(defer)
+            columns = [f for f in cls.__fields__ if f not in deferred]
+        for name in list(only or ()) + list(defer or ()):
+            if name not in cls.__mappings__:
+                raise ValueError('Invalid field name: %s' % name)
+        key = tuple(columns)
+        sql = cls.__select_cache__.get(key)
+        if sql is None:
+            sql = ', '.join(['`%s`' % cls.__primaryKey__] + ['`%s`' % f for f in columns])
+            sql = 'select %s from `%s`' % (sql, cls.__table__)
+            cls.__select_cache__[key] = sql
+        return sql, frozenset(cls.__fields__).difference(columns)
+
+    async def load(self, *names):
+        """
+        按需加载当前实例未加载的列，不指定 names 则加载全部未加载的列
+        """
+        await self.__class__.loadDeferred([self], *names)
+
+    @classmethod
+    async def loadDeferred(cls, objs, *names):
+        """
+        为一组实例批量加载未加载的列，只发送一条 where pk in (...) 查询，避免逐行查询
+        """
+        names = set(names) if names else set().union(*(o._deferred for o in objs))
+        pending = {o.getValue(cls.__primaryKey__): o for o in objs if names & o._deferred}
+        if not pending:
+            return
+        columns = [f for f in cls.__fields__ if f in names]
+        sql = 'select `%s`, %s from `%s` where `%s` in (%s)' % (
+            cls.__primaryKey__, ', '.join('`%s`' % f for f in columns), cls.__table__,
+            cls.__primaryKey__, _in_args_string(len(pending)))
+        rs = await select(sql, list(pending.keys()))
+        for r in rs:
+            obj = pending.get(r[cls.__primaryKey__])
+            if obj is None:
+                continue
+            for f in columns:
+                dict.__setitem__(obj, f, r[f])
+            obj.__dict__['_deferred'] = obj._deferred.difference(columns)
+
     # 数据库方法
     @classmethod
     async def findAll(cls, where=None, args=None, **kw):
         """
         find objects by where clause.
+        - only: 只查询指定的列，其余列延迟加载
+        - defer: 不查询指定的列（lazy=True 的列默认不查询）
+        - cache: 缓存查询结果，True 使用默认过期时间，数字为过期时间（秒）；该表有写操作时缓存失效
+        - prefetch: 批量加载的关联，如 ['user', 'comments', 'comments.user']，见 prefetch 方法
         """
-        sql = [cls.__select__]
+        select_sql, deferred = cls._selectColumns(kw.get('only', None), kw.get('defer', None))
+        sql = [select_sql]
 
         if where:
             sql.append('where')
@@ -253,56 +835,240 @@ class Model(dict, metaclass=ModelMetaclass):  # 继承 dict，支持字典的读
             else:
                 raise ValueError('Invalid limit value: %s' % str(limit))
 
-        rs = await select(' '.join(sql), args)
+        rs = await _cached_select(cls.__table__, ' '.join(sql), args, ttl=kw.get('cache', None))
 
-        # **r 将字典 r 拆解，作为变量传给函数
-        # cls() 相当于调用了当前类的构造函数
-        return [cls(**r) for r in rs]
+        # __from_row__ 由 ModelMetaclass 生成，直接用查询结果构造实例，比 cls(**r) 少一次关键字参数解包
+        from_row = cls.__from_row__
+        objs = [from_row(r, deferred) for r in rs]
+        prefetch = kw.get('prefetch', None)
+        if prefetch:
+            await cls.prefetch(objs, *prefetch)
+        return objs
 
     @classmethod
-    async def findNumber(cls, selectField, where=None, args=None):
-        """ find number by select and where. """
+    async def findNumber(cls, selectField, where=None, args=None, cache=None):
+        """ find number by select and where. cache 的含义同 findAll """
         sql = ['select %s _num_ from `%s`' % (selectField, cls.__table__)]
         if where:
             sql.append('where')
             sql.append(where)
-        rs = await select(' '.join(sql), args, 1)
+        rs = await _cached_select(cls.__table__, ' '.join(sql), args, 1, cache)
         if len(rs) == 0:
             return None
         return rs[0]['_num_']
 
     @classmethod
-    async def find(cls, pk):
-        """ find object by primary key. """
-        rs = await select('%s where `%s`=?' % (cls.__select__, cls.__primaryKey__), [pk], 1)
-        if len(rs) == 0:
-            return None
-        return cls(**rs[0])
+    async def find(cls, pk, only=None, defer=None, prefetch=None, cache=None):
+        """
+        find object by primary key.
+        cache: 通过缓存后端（www.cache.get_backend，可在多个 worker 之间共享）缓存查询到的行，
+            True 使用默认过期时间，数字为过期时间（秒）；只对默认的列（不指定 only/defer）生效，
+            该行被 save、update、remove 时删除缓存。
+            与 QueryCache 的标签版本号相同，每行有一个代（generation），写操作在删除缓存前更新它；
+            查询前后的代不同时，查询到的可能是旧数据，不写入缓存，避免旧数据在删除之后又被写回。
+            只能用于 __cache_rows__ 为 True 的 Model
+        """
+        select_sql, deferred = cls._selectColumns(only, defer)
+        key = row = None
+        if cache and not cls.__cache_rows__:
+            raise ValueError('row cache is not enabled for %s, set __cache_rows__ = True' % cls.__name__)
+        if cache and only is None and defer is None:
+            key = cls._cacheKey(pk)
+            row = await get_backend().get(key)
+        if row is None:
+            if key is not None:
+                generation = await get_backend().get(_ROW_GENERATION % key)
+            rs = await select('%s where `%s`=?' % (select_sql, cls.__primaryKey__), [pk], 1)
+            if len(rs) == 0:
+                return None
+            row = rs[0]
+            if key is not None and await get_backend().get(_ROW_GENERATION % key) == generation:
+                await get_backend().set(key, row, None if cache is True else cache)
+        obj = cls.__from_row__(row, deferred)
+        if prefetch:
+            await cls.prefetch([obj], *prefetch)
+        return obj
+
+    @classmethod
+    def _cacheKey(cls, pk):
+        return 'find:%s:%s' % (cls.__table__, pk)
+
+    async def _invalidateRow(self):
+        """更新该行的代并删除 find 缓存的该行，使该表缓存的查询结果失效"""
+        invalidate(self.__table__)
+        if not self.__cache_rows__:
+            return
+        key = self._cacheKey(self.get(self.__primaryKey__))
+        backend = get_backend()
+        await backend.set(_ROW_GENERATION % key, uuid.uuid4().hex, _ROW_GENERATION_TTL)
+        await backend.delete(key)
+
+    # 关联
+    @classmethod
+    def _relations(cls):
+        """
+        当前 Model 的关联：名称 => (类型, 列名, 关联的 Model)
+        - 'one': 当前 Model 的列引用了其他 Model 的主键，如 Blog.user
+        - 'many': 其他 Model 的列引用了当前 Model 的主键，如 Blog.comments
+        """
+        relations = dict()
+        for model, field, references, forward, backward in _references:
+            target = _models.get(references)
+            if target is None:
+                raise ValueError('Model not found: %s (referenced by %s.%s)' % (references, model.__name__, field))
+            if model is cls:
+                relations[forward] = ('one', field, target)
+            if target is cls:
+                # 反向关联名在被引用的 Model 定义时还无法检查，在这里检查
+                if backward in cls.__mappings__:
+                    raise ValueError('related name %s of %s.%s collides with a field of %s' % (
+                        backward, model.__name__, field, cls.__name__))
+                if backward in relations:
+                    raise ValueError('duplicate relation name %s on %s' % (backward, cls.__name__))
+                relations[backward] = ('many', field, model)
+        return relations
 
-    async def save(self):
+    @classmethod
+    async def _findIn(cls, field, values):
+        if not values:
+            return []
+        return await cls.findAll('`%s` in (%s)' % (field, _in_args_string(len(values))), list(values))
+
+    @classmethod
+    async def prefetch(cls, objs, *names):
+        """
+        为一组实例批量加载关联的行，每个关联只发送一条 where ... in (...) 查询，避免逐个查询（N+1）
+        加载的结果作为实例属性（不是 dict 的键），如 blog.user 为 User 实例或 None，blog.comments 为 Comment 列表。
+        用 '.' 加载关联的关联，如 'comments.user'
+        """
+        nested = dict()
+        for name in names:
+            head, _, rest = name.partition('.')
+            nested.setdefault(head, [])
+            if rest:
+                nested[head].append(rest)
+        relations = cls._relations()
+        for name, rest in nested.items():
+            if name not in relations:
+                raise ValueError('Invalid relation name: %s' % name)
+            kind, field, model = relations[name]
+            if kind == 'one':
+                keys = {o.getValue(field) for o in objs}
+                keys.discard(None)
+                found = await model._findIn(model.__primaryKey__, keys)
+                index = {r.getValue(model.__primaryKey__): r for r in found}
+                for o in objs:
+                    o.__dict__[name] = index.get(o.getValue(field))
+            else:
+                keys = {o.getValue(cls.__primaryKey__) for o in objs}
+                found = await model._findIn(field, keys)
+                index = dict()
+                for r in found:
+                    index.setdefault(r.getValue(field), []).append(r)
+                for o in objs:
+                    o.__dict__[name] = index.get(o.getValue(cls.__primaryKey__), [])
+            if rest and found:
+                await model.prefetch(found, *rest)
+
+    @classmethod
+    def _upsertSql(cls, fields):
+        """生成并缓存 INSERT ... ON DUPLICATE KEY UPDATE 语句，冲突时只更新 fields 中的列"""
+        key = tuple(fields)
+        sql = cls.__upsert_cache__.get(key)
+        if sql is None:
+            for f in fields:
+                if f not in cls.__mappings__:
+                    raise ValueError('Invalid field name: %s' % f)
+            columns = [cls.__mappings__[f].name or f for f in fields]
+            update_str = ', '.join(map(lambda c: f'`{c}`=values(`{c}`)', columns))
+            sql = f'{cls.__insert__} on duplicate key update {update_str}'
+            cls.__upsert_cache__[key] = sql
+        return sql
+
+    async def save(self, on_conflict=None):
         """
         将当前实例的数据作为行插入表格
         需要按表格定义的列（__mappings__）准备数据，如果实例不包含某列，则取默认值
+        :param on_conflict: 违反主键或唯一索引时的处理方式，只需一条语句，省去先查询再插入的往返
+            - None: 抛出 DuplicateKeyError
+            - 'ignore': 使用 INSERT IGNORE，不插入也不报错
+            - 'update': 使用 INSERT ... ON DUPLICATE KEY UPDATE，更新除主键外的所有列
+            - 列名的列表: 同 'update'，但只更新指定的列
+            冲突可能发生在其他唯一索引上，被更新的行的主键未知，无法删除 find 缓存的行，
+            所以 __cache_rows__ 为 True 的 Model 不能使用 'update' 和列名的列表
+        :return: 影响的行数。INSERT IGNORE 冲突时为 0；ON DUPLICATE KEY UPDATE 插入为 1，更新为 2，值未变化为 0
         """
-        args = list(map(self.getValueOrDefault, self.__fields__))
-        args.append(self.getValueOrDefault(self.__primaryKey__))
-        rows = await execute(self.__insert__, args)
-        if rows != 1:
+        args = self.__insert_args__()  # 由 ModelMetaclass 生成，等价于对每列调用 getValueOrDefault
+        if on_conflict is None:
+            sql = self.__insert__
+        elif on_conflict == 'ignore':
+            sql = self.__insert_ignore__
+        elif self.__cache_rows__ and (on_conflict == 'update' or isinstance(on_conflict, (list, tuple))):
+            raise ValueError('%s caches rows, upsert is not supported' % self.__class__.__name__)
+        elif on_conflict == 'update':
+            sql = self._upsertSql(self.__fields__)
+        elif isinstance(on_conflict, (list, tuple)):
+            sql = self._upsertSql(on_conflict)
+        else:
+            raise ValueError('Invalid on_conflict value: %s' % str(on_conflict))
+        rows = await execute(sql, args)
+        await self._invalidateRow()
+        if on_conflict is None and rows != 1:
             logging.warning('failed to insert record: affected rows: %s' % rows)
+        self._markClean()
+        return rows
+
+    @classmethod
+    def _updateSql(cls, fields):
+        """按列集合生成并缓存 UPDATE 语句"""
+        key = tuple(fields)
+        sql = cls.__update_cache__.get(key)
+        if sql is None:
+            update_str = ', '.join(map(lambda f: f'`{cls.__mappings__.get(f).name or f}`=?', fields))
+            sql = f'update `{cls.__table__}` set {update_str} where `{cls.__primaryKey__}`=?'
+            cls.__update_cache__[key] = sql
+        return sql
 
-    async def update(self):
+    async def update(self, where=None, args=None):
         """
         需要更新的数据一定出现在实例的attributes（已经经过save补全了列数据，或是从数据库读反序列化得到的）
         所以用 self.getValue 而不是 self.getValueOrDefault
+        未加载的列不会被写回，避免用 None 覆盖数据库中的值
+        从数据库加载或保存过的实例只写被修改过的列（通过属性或下标赋值），没有修改时不发送语句
+        :param where: 附加的更新条件，用于乐观并发控制，如 update(where='`version`=?', args=[old_version])
+        :param args: where 中占位符对应的参数
+        :return: 影响的行数，附加条件不满足时为 0；
+            没有需要写的列时不发送语句（也不检查 where），返回 None，调用方不能把它当作条件不满足
         """
-        args = list(map(self.getValue, self.__fields__))
-        args.append(self.getValue(self.__primaryKey__))
-        rows = await execute(self.__update__, args)
-        if rows != 1:
+        if self._dirty is not None:
+            fields = [f for f in self.__fields__ if f in self._dirty]
+        elif self._deferred:
+            fields = [f for f in self.__fields__ if f not in self._deferred]
+        else:
+            fields = self.__fields__
+        if not fields:
+            return None
+        if len(fields) == len(self.__fields__):
+            sql = self.__update__
+            values = self.__update_args__()  # 由 ModelMetaclass 生成
+        else:
+            sql = self._updateSql(fields)
+            values = list(map(self.get, fields))
+            values.append(self.get(self.__primaryKey__))
+        if where:
+            sql = '%s and (%s)' % (sql, where)
+            values.extend(args or ())
+        rows = await execute(sql, values)
+        await self._invalidateRow()
+        if rows != 1 and not where:
             logging.warning('failed to update by primary key: affected rows: %s' % rows)
+        if rows or not where:
+            self._markClean()
+        return rows
 
     async def remove(self):
         args = [self.getValue(self.__primaryKey__)]
         rows = await execute(self.__delete__, args)
+        await self._invalidateRow()
         if rows != 1:
             logging.warning('failed to remove by primary key: affected rows: %s' % rows)
@@ -0,0 +1,247 @@
+"""
+在线上 worker 中按需做性能分析，路由都在 /manage/ 下，由 auth middleware 限制只有管理员可以访问：
+    1. /manage/profile/cpu：在限定时间内对事件循环所在线程做采样式 CPU 分析，
+       返回按函数汇总的文本，或可用 flamegraph.pl / speedscope 打开的 collapsed stack 文件；
+    2. 管理员的请求带上 ?_profile=1 或 X-Profile: 1 头时，用 cProfile 分析该请求，
+       结果保存为 pstats 文件，文件名放在响应头 X-Profile-Id 中（由 on_response_prepare 加上，流式响应也有）；
+    3. /manage/profile/memory：用 tracemalloc 统计一段时间内增长最多的内存分配位置；
+    4. /manage/profiles 列出保存的 pstats 文件，/manage/profiles/{name} 下载。
+"""
+
+import asyncio
+import collections
+import cProfile
+import io
+import logging
+import pstats
+import re
+import sys
+import tempfile
+import threading
+import time
+import tracemalloc
+from pathlib import Path
+
+from aiohttp import web
+
+from www.apis import APIError, APIValueError, APIResourceNotFoundError
+from www.config import configs
+from www.coroweb import get
+
+_PROFILE_DIR = Path(configs.profiling.dir or Path(tempfile.gettempdir()) / 'awesome-profiles')
+_RE_PROFILE_NAME = re.compile(r'^[\w.\-]+\.pstats$')
+# 同一时间只允许一个采样/内存分析，避免多个分析互相干扰
+_busy = asyncio.Lock()
+# 采样间隔的范围（毫秒）：间隔过小时采样线程几乎一直占用 GIL，拖慢被分析的 worker
+_MIN_INTERVAL = 1
+_MAX_INTERVAL = 1000
+
+
+class StackSampler(threading.Thread):
+    """
+    每隔 interval 秒采样一次目标线程的调用栈，按完整调用栈计数
+    在单独的线程中运行，被分析的事件循环不需要做任何配合
+    """
+
+    def __init__(self, thread_id, interval=0.005):
+        super().__init__(daemon=True)
+        self.thread_id = thread_id
+        self.interval = interval
+        self.stacks = collections.Counter()
+        self.samples = 0
+        self._stop_event = threading.Event()
+
+    def run(self):
+        while not self._stop_event.wait(self.interval):
+            frame = sys._current_frames().get(self.thread_id)
+            stack = []
+            while frame is not None:
+                code = frame.f_code
+                stack.append('%s (%s:%d)' % (code.co_name, code.co_filename, code.co_firstlineno))
+                frame = frame.f_back
+            if stack:
+                self.stacks[';'.join(reversed(stack))] += 1
+                self.samples += 1
+
+    def stop(self):
+        self._stop_event.set()
+        self.join()
+
+    def collapsed(self):
+        """flamegraph 使用的 collapsed stack 格式，每行：调用栈（以 ; 分隔） 采样次数"""
+        return '\n'.join('%s %d' % (stack, n) for stack, n in self.stacks.most_common())
+
+    def summary(self, top=40):
+        """按函数汇总：self 为位于栈顶的采样比例，total 为出现在栈中的采样比例"""
+        own, total = collections.Counter(), collections.Counter()
+        for stack, n in self.stacks.items():
+            funcs = stack.split(';')
+            own[funcs[-1]] += n
+            for f in set(funcs):
+                total[f] += n
+        lines = ['samples: %d, interval: %.1fms' % (self.samples, self.interval * 1000), '',
+                 '  self%  total%  function']
+        for f, n in total.most_common(top):
+            lines.append('%6.1f%% %6.1f%%  %s' % (own[f] * 100 / self.samples, n * 100 / self.samples, f))
+        return '\n'.join(lines)
+
+
+def _text(text):
+    return web.Response(text=text, content_type='text/plain', charset='utf-8')
+
+
+def _attachment(body, filename):
+    resp = web.Response(body=body, content_type='application/octet-stream')
+    resp.headers['Content-Disposition'] = 'attachment; filename="%s"' % filename
+    return resp
+
+
+def _seconds(value, limit):
+    try:
+        seconds = float(value)
+    except ValueError:
+        raise APIValueError('seconds', 'Invalid seconds.')
+    if not 0 < seconds <= limit:
+        raise APIValueError('seconds', 'seconds must be between 0 and %s.' % limit)
+    return seconds
+
+
+def _interval(value):
+    """采样间隔，由毫秒转换为秒"""
+    try:
+        interval = float(value)
+    except ValueError:
+        raise APIValueError('interval', 'Invalid interval.')
+    if not _MIN_INTERVAL <= interval <= _MAX_INTERVAL:
+        raise APIValueError('interval', 'interval must be between %s and %s ms.' % (_MIN_INTERVAL, _MAX_INTERVAL))
+    return interval / 1000
+
+
+def _top(value):
+    try:
+        top = int(value)
+    except ValueError:
+        raise APIValueError('top', 'Invalid top.')
+    if top <= 0:
+        raise APIValueError('top', 'top must be positive.')
+    return top
+
+
+@get('/manage/profile/cpu')
+async def manage_profile_cpu(*, seconds='10', interval='5', output='text'):
+    """
+    采样 seconds 秒事件循环线程的调用栈
+    :param interval: 采样间隔（毫秒）
+    :param output: text 为按函数汇总的文本；collapsed 为下载 collapsed stack 文件
+    """
+    seconds = _seconds(seconds, configs.profiling.max_seconds)
+    interval = _interval(interval)
+    if _busy.locked():
+        raise APIError('profile:busy', 'profile', 'Another profile is running.')
+    async with _busy:
+        sampler = StackSampler(threading.get_ident(), interval)
+        sampler.start()
+        try:
+            await asyncio.sleep(seconds)
+        finally:
+            await asyncio.get_event_loop().run_in_executor(None, sampler.stop)
+    if sampler.samples == 0:
+        return _text('no samples')
+    if output == 'collapsed':
+        return _attachment(sampler.collapsed().encode('utf-8'), 'cpu-%d.collapsed' % int(time.time()))
+    return _text(sampler.summary())
+
+
+@get('/manage/profile/memory')
+async def manage_profile_memory(*, seconds='10', top='30'):
+    """
+    统计 seconds 秒内增长最多的内存分配位置，以及当前占用最多的位置
+    tracemalloc 会明显拖慢分配速度，如果分析前没有开启，分析结束后会关闭
+    """
+    seconds = _seconds(seconds, configs.profiling.max_seconds)
+    top = _top(top)
+    if _busy.locked():
+        raise APIError('profile:busy', 'profile', 'Another profile is running.')
+    loop = asyncio.get_event_loop()
+    async with _busy:
+        started = not tracemalloc.is_tracing()
+        if started:
+            tracemalloc.start(10)
+        try:
+            before = tracemalloc.take_snapshot()
+            await asyncio.sleep(seconds)
+            after = tracemalloc.take_snapshot()
+        finally:
+            if started:
+                tracemalloc.stop()
+
+    def report():
+        lines = ['top %d allocation growth in %.1fs:' % (top, seconds)]
+        lines.extend(str(stat) for stat in after.compare_to(before, 'lineno')[:top])
+        lines.extend(['', 'top %d allocations:' % top])
+        lines.extend(str(stat) for stat in after.statistics('lineno')[:top])
+        return '\n'.join(lines)
+
+    return _text(await loop.run_in_executor(None, report))
+
+
+@get('/manage/profiles')
+async def manage_profiles():
+    """列出保存的单请求 pstats 文件，最新的在前"""
+    if not _PROFILE_DIR.exists():
+        return _text('')
+    files = sorted(_PROFILE_DIR.glob('*.pstats'), key=lambda p: p.stat().st_mtime, reverse=True)
+    return _text('\n'.join(p.name for p in files))
+
+
+@get('/manage/profiles/{name}')
+async def manage_profile_file(*, name, output='pstats'):
+    """
+    下载保存的 pstats 文件（可用 snakeviz 等工具打开）
+    :param output: pstats 为下载原文件；text 为按累计耗时排序的文本
+    """
+    path = _PROFILE_DIR / name
+    if not _RE_PROFILE_NAME.match(name) or not path.exists():
+        raise APIResourceNotFoundError('profile')
+    if output == 'text':
+        buf = io.StringIO()
+        pstats.Stats(str(path), stream=buf).sort_stats('cumulative').print_stats(60)
+        return _text(buf.getvalue())
+    return web.FileResponse(path, headers={'Content-Disposition': 'attachment; filename="%s"' % name})
+
+
+def _dump_stats(profile, path):
+    _PROFILE_DIR.mkdir(parents=True, exist_ok=True)
+    profile.dump_stats(str(path))
+
+
+@web.middleware
+async def request_profiler(request, handler):
+    """
+    管理员的请求带上 ?_profile=1 或 X-Profile: 1 时，用 cProfile 分析该请求
+    需要放在 auth 之后；分析期间同一线程中其他请求的代码也会被统计进来
+    """
+    flag = request.query.get('_profile') or request.headers.get('X-Profile')
+    user = getattr(request, '__user__', None)
+    if not flag or user is None or not user.admin or _busy.locked():
+        return await handler(request)
+    # 文件名在分析前确定，流式响应在 handler 返回前就发送了响应头，由 on_response_prepare 加上 X-Profile-Id
+    name = '%d-%s.pstats' % (int(time.time() * 1000), re.sub(r'[^\w]+', '_', request.path).strip('_') or 'index')
+    request['profile_id'] = name
+    async with _busy:
+        profile = cProfile.Profile()
+        profile.enable()
+        try:
+            resp = await handler(request)
+        finally:
+            profile.disable()
+    await asyncio.get_event_loop().run_in_executor(None, _dump_stats, profile, _PROFILE_DIR / name)
+    logging.info('profile of %s %s saved to %s' % (request.method, request.path, name))
+    return resp
+
+
+async def on_response_prepare(request, response):
+    """用于 app.on_response_prepare，在响应头发送前加上 X-Profile-Id 头"""
+    name = request.get('profile_id')
+    if name is not None:
+        response.headers['X-Profile-Id'] = name
@@ -0,0 +1,123 @@
+"""
+轻量级的请求追踪
+每个请求一个 Trace 对象，通过 context variable 在 middleware、RequestHandler 和 ORM 之间传递，
+各环节用 span 记录耗时，最后按名称汇总，作为 Server-Timing 响应头返回给浏览器（开发者工具中可直接查看）。
+响应头在发送前（app.on_response_prepare）加上，流式响应也有该头，但只包含开始发送之前的耗时。
+按采样率把请求内执行的 SQL 语句及耗时写入日志。
+"""
+
+import contextlib
+import contextvars
+import logging
+import random
+import time
+
+from aiohttp import web
+
+# 当前请求的 Trace，没有开启追踪时为 None
+_current = contextvars.ContextVar('trace', default=None)
+
+
+class Trace:
+    """记录一个请求内各环节的耗时"""
+
+    def __init__(self):
+        self.started = time.perf_counter()
+        self.timings = dict()  # 名称 => [总耗时（秒）, 次数]，按首次出现的顺序排列
+        self.statements = list()  # (SQL, 耗时)
+
+    def add(self, name, duration):
+        timing = self.timings.get(name)
+        if timing is None:
+            self.timings[name] = [duration, 1]
+        else:
+            timing[0] += duration
+            timing[1] += 1
+
+    def elapsed(self):
+        return time.perf_counter() - self.started
+
+    def server_timing(self):
+        """
+        生成 Server-Timing 头，耗时单位为毫秒
+        e.g. pool;dur=0.1, sql;dur=3.2;desc="2 queries", handler;dur=5.0, total;dur=6.3
+        """
+        items = []
+        for name, (duration, count) in self.timings.items():
+            item = '%s;dur=%.1f' % (name, duration * 1000)
+            if count > 1:
+                item += ';desc="%d calls"' % count
+            items.append(item)
+        items.append('total;dur=%.1f' % (self.elapsed() * 1000))
+        return ', '.join(items)
+
+
+@contextlib.contextmanager
+def span(name):
+    """
+    记录 with 语句块的耗时，没有开启追踪时什么也不做
+    e.g. with span('render'): ...
+    """
+    trace = _current.get()
+    if trace is None:
+        yield
+        return
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        trace.add(name, time.perf_counter() - start)
+
+
+@contextlib.contextmanager
+def sql_span(sql):
+    """记录一条 SQL 语句的耗时，同时保存语句本身，用于采样日志"""
+    trace = _current.get()
+    if trace is None:
+        yield
+        return
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        duration = time.perf_counter() - start
+        trace.add('sql', duration)
+        trace.statements.append((sql, duration))
+
+
+def tracing_factory(sample_rate=0.0):
+    """
+    通过闭包的方式将采样率注入 middleware，并返回该闭包
+    :param sample_rate: 把 SQL 语句列表写入日志的请求比例，0 ~ 1
+    """
+
+    @web.middleware
+    async def tracing(request, handler):
+        """
+        为请求创建 Trace，Server-Timing 头由 on_response_prepare 加上
+        应当作为第一个 middleware，以便统计整个请求的耗时
+        """
+        trace = Trace()
+        request['trace'] = trace
+        token = _current.set(trace)
+        try:
+            resp = await handler(request)
+        finally:
+            _current.reset(token)
+        if sample_rate and random.random() < sample_rate:
+            lines = ['%8.1fms  %s' % (d * 1000, sql) for sql, d in trace.statements]
+            logging.info('trace %s %s: %s\n%s' % (request.method, request.path, trace.server_timing(),
+                                                 '\n'.join(lines)))
+        return resp
+
+    return tracing
+
+
+async def on_response_prepare(request, response):
+    """
+    用于 app.on_response_prepare，在响应头发送前加上 Server-Timing 头
+    流式响应在 handler 中调用 prepare，此时 handler 尚未返回，只能报告到开始发送为止的耗时
+    """
+    trace = request.get('trace')
+    if trace is not None:
+        response.headers['Server-Timing'] = trace.server_timing()